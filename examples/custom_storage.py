@@ -10,12 +10,9 @@ class MyStorage(StorageBase):
         if not os.path.exists('downloads'):
             os.mkdir('downloads')
 
-    def write(self, file_piece_list, data):
-        for file_piece in file_piece_list:
-            path_file = os.path.join('downloads', file_piece["path"].split('/')[-1])
-            file_offset = file_piece["fileOffset"]
-            piece_offset = file_piece["pieceOffset"]
-            length = file_piece["length"]
+    def write(self, spans, data):
+        for span in spans:
+            path_file = os.path.join('downloads', span.path.split('/')[-1])
 
             try:
                 f = open(path_file, 'r+b')
@@ -25,30 +22,24 @@ class MyStorage(StorageBase):
                 print("Can't write to file")
                 return
 
-            f.seek(file_offset)
-            f.write(data[piece_offset:piece_offset + length])
+            f.seek(span.file_offset)
+            f.write(data[span.data_offset:span.data_offset + span.length])
             f.close()
 
-    def read(self, files, block_offset, block_length):
-        file_data_list = []
-        for file in files:
-            path_file = file["path"]
-            file_offset = file["fileOffset"]
-            piece_offset = file["pieceOffset"]
-            length = file["length"]
+    def read(self, spans, length):
+        data = bytearray(length)
+        for span in spans:
+            path_file = os.path.join('downloads', span.path.split('/')[-1])
 
             try:
                 f = open(path_file, 'rb')
             except:
                 print("Can't read file %s" % path_file)
                 return
-            f.seek(file_offset)
-            data = f.read(length)
-            file_data_list.append((piece_offset, data))
+            f.seek(span.file_offset)
+            data[span.data_offset:span.data_offset + span.length] = f.read(span.length).ljust(span.length, b'\0')
             f.close()
-        file_data_list.sort(key=lambda x: x[0])
-        piece = b''.join([data for _, data in file_data_list])
-        return piece[block_offset : block_offset + block_length]
+        return data
 
 
 if __name__ == '__main__':
@@ -0,0 +1,72 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import argparse
+import random
+import shutil
+import tempfile
+import time
+from ltorrent.storage import Storage, ALLOCATION_NONE, ALLOCATION_SPARSE, ALLOCATION_FULL
+from ltorrent.file_table import FileTable
+
+# write the pieces of a fake torrent in random order, as a download does, then read its files in order
+# from the disk, for every allocation mode, needs os.posix_fadvise to drop the page cache
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=256, help='torrent size in MB')
+    parser.add_argument('--files', type=int, default=4, help='number of files')
+    parser.add_argument('--piece-length', type=int, default=1024, help='piece length in KB')
+    parser.add_argument('--dir', default=None, help='directory on the disk to measure, a temporary one by default')
+    args = parser.parse_args()
+
+    piece_length = args.piece_length * 1024
+    file_length = args.size * 1024 * 1024 // args.files
+    total_length = file_length * args.files
+    number_of_pieces = (total_length + piece_length - 1) // piece_length
+
+    piece_data = memoryview(os.urandom(piece_length))
+    piece_order = list(range(number_of_pieces))
+    random.shuffle(piece_order)
+
+    for allocation in (ALLOCATION_NONE, ALLOCATION_SPARSE, ALLOCATION_FULL):
+        root = tempfile.mkdtemp(dir=args.dir)
+        file_names = [{'path': os.path.join(root, 'file%d' % i), 'length': file_length} for i in range(args.files)]
+        file_table = FileTable(file_names=file_names, selection=range(args.files), piece_length=piece_length)
+        storage = Storage(allocation=allocation)
+
+        start = time.time()
+        for file in file_names:
+            storage.allocate(file['path'], file['length'])
+        allocate_time = time.time() - start
+        allocated_size = sum(os.stat(file['path']).st_blocks * 512 for file in file_names if os.path.exists(file['path']))
+
+        start = time.time()
+        for piece_index in piece_order:
+            spans = file_table.get_piece_spans(piece_index)
+            storage.write_buffers(spans, [piece_data[:sum(span.length for span in spans)]])
+        storage.flush()
+        write_time = time.time() - start
+        storage.close()
+
+        # the data is on disk after flush, drop it from the page cache so the reads hit the disk
+        for file in file_names:
+            fd = os.open(file['path'], os.O_RDONLY)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            os.close(fd)
+
+        start = time.time()
+        for piece_index in range(number_of_pieces):
+            spans = file_table.get_piece_spans(piece_index)
+            storage.read(spans, sum(span.length for span in spans))
+        storage.close()
+        read_time = time.time() - start
+
+        print("%-6s allocate %.2fs, %.2fMB on disk | write %.2fMB/s | read %.2fMB/s" % (
+            allocation,
+            allocate_time,
+            allocated_size / 1024 / 1024,
+            total_length / 1024 / 1024 / max(write_time, 0.001),
+            total_length / 1024 / 1024 / max(read_time, 0.001)
+        ))
+
+        shutil.rmtree(root)
@@ -0,0 +1,27 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from ltorrent.client import Client
+
+if __name__ == '__main__':
+    magnet_link = "magnet:?xt=urn:btih:dd8255ecdc7ca55fb0bbf81323d87062db1f6d1c&dn=Big+Buck+Bunny&tr=udp%3A%2F%2Fexplodie.org%3A6969&tr=udp%3A%2F%2Ftracker.coppersurfer.tk%3A6969&tr=udp%3A%2F%2Ftracker.empire-js.us%3A1337&tr=udp%3A%2F%2Ftracker.leechers-paradise.org%3A6969&tr=udp%3A%2F%2Ftracker.opentrackr.org%3A1337&tr=wss%3A%2F%2Ftracker.btorrent.xyz&tr=wss%3A%2F%2Ftracker.fastcast.nz&tr=wss%3A%2F%2Ftracker.openwebtorrent.com&ws=https%3A%2F%2Fwebtorrent.io%2Ftorrents%2F&xs=https%3A%2F%2Fwebtorrent.io%2Ftorrents%2Fbig-buck-bunny.torrent"
+    port = 8080
+
+    client = Client(
+        port=port
+    )
+
+    client.load(magnet_link=magnet_link)
+    client.list_file()
+    selection = input("Select file: ")
+    client.select_file(selection=selection)
+
+    # the first selected file, read in order while the torrent downloads
+    stream = client.open_stream(file_id=client.selection[0])
+    client.start()
+
+    with stream, open('stream.out', 'wb') as f:
+        for data in stream:
+            f.write(data)
+
+    client.join()
@@ -1,9 +1,15 @@
 __author__ = 'alexisgallepe, L-ING'
 
+import math
+import time
+from array import array
+from collections import deque
 from enum import Enum
 
 # 2 ** 14
 BLOCK_SIZE = 16384
+# seconds before a pending block is set free again
+PENDING_TIMEOUT = 5
 
 
 class State(Enum):
@@ -12,12 +18,142 @@ class State(Enum):
     FULL = 2
 
 
-class Block():
-    def __init__(self, state: State = State.FREE, block_size: int = BLOCK_SIZE, data: bytes = b'', last_seen: float = 0):
-        self.state: State = state
-        self.block_size: int = block_size
-        self.data: bytes = data
-        self.last_seen: float = last_seen
+_FREE = State.FREE.value
+_PENDING = State.PENDING.value
+_FULL = State.FULL.value
 
-    def __str__(self):
-        return "%s - %d - %d - %d" % (self.state, self.block_size, len(self.data), self.last_seen)
+
+class BlockTable(object):
+    """
+    State of every block of the torrent, indexed by a global block index:
+
+    block_index = piece_index * blocks_per_piece + block_offset // BLOCK_SIZE
+
+    - states = one State value per block (bytearray)
+    - last_seen = time the block was last set pending (array of doubles)
+    - full_blocks = number of full blocks per piece (array of unsigned ints)
+
+    Block sizes are not stored, they only depend on the block position.
+    """
+
+    def __init__(self, number_of_pieces: int, piece_size: int, last_piece_size: int):
+        self.number_of_pieces: int = number_of_pieces
+        self.piece_size: int = piece_size
+        self.last_piece_size: int = last_piece_size
+        self.blocks_per_piece: int = math.ceil(piece_size / BLOCK_SIZE)
+        self.last_piece_blocks: int = math.ceil(last_piece_size / BLOCK_SIZE)
+        self.number_of_blocks: int = (number_of_pieces - 1) * self.blocks_per_piece + self.last_piece_blocks
+
+        self.states = bytearray(self.number_of_blocks)
+        self.last_seen = array('d', bytes(8 * self.number_of_blocks))
+        self.full_blocks = array('I', bytes(4 * number_of_pieces))
+        # (last_seen, block_index) in the order blocks were set pending
+        self.pending = deque()
+        # every block before the cursor is known not to be free
+        self.free_cursor: int = 0
+
+    def get_block_index(self, piece_index, block_offset):
+        return piece_index * self.blocks_per_piece + block_offset // BLOCK_SIZE
+
+    def get_piece_range(self, piece_index):
+        start = piece_index * self.blocks_per_piece
+        if piece_index == self.number_of_pieces - 1:
+            return start, start + self.last_piece_blocks
+        return start, start + self.blocks_per_piece
+
+    def get_block_info(self, block_index):
+        piece_index = block_index // self.blocks_per_piece
+        block_offset = (block_index - piece_index * self.blocks_per_piece) * BLOCK_SIZE
+
+        if piece_index == self.number_of_pieces - 1:
+            piece_size = self.last_piece_size
+        else:
+            piece_size = self.piece_size
+
+        return piece_index, block_offset, min(BLOCK_SIZE, piece_size - block_offset)
+
+    def get_block_size(self, block_index):
+        return self.get_block_info(block_index)[2]
+
+    def get_state(self, block_index):
+        return State(self.states[block_index])
+
+    def next_free(self, start=0, end=None):
+        if end is None:
+            end = self.number_of_blocks
+
+        block_index = self.states.find(_FREE, max(start, self.free_cursor), end)
+
+        if block_index == -1:
+            if start <= self.free_cursor:
+                self.free_cursor = max(self.free_cursor, end)
+            return None
+
+        if start <= self.free_cursor:
+            self.free_cursor = block_index
+        return block_index
+
+    def get_pending_blocks(self, start=0, end=None):
+        if end is None:
+            end = self.number_of_blocks
+
+        block_index = self.states.find(_PENDING, start, end)
+        while block_index != -1:
+            yield block_index
+            block_index = self.states.find(_PENDING, block_index + 1, end)
+
+    def set_pending(self, block_index):
+        now = time.time()
+        self.states[block_index] = _PENDING
+        self.last_seen[block_index] = now
+        self.pending.append((now, block_index))
+
+    def set_full(self, block_index):
+        if self.states[block_index] == _FULL:
+            return False
+
+        self.states[block_index] = _FULL
+        self.full_blocks[block_index // self.blocks_per_piece] += 1
+        return True
+
+    def set_free(self, block_index):
+        if self.states[block_index] == _FULL:
+            self.full_blocks[block_index // self.blocks_per_piece] -= 1
+
+        self.states[block_index] = _FREE
+        self.free_cursor = min(self.free_cursor, block_index)
+
+    def expire_pending(self, timeout=PENDING_TIMEOUT):
+        deadline = time.time() - timeout
+
+        while self.pending and self.pending[0][0] < deadline:
+            last_seen, block_index = self.pending.popleft()
+            # skip blocks which are full or were set pending again since
+            if self.states[block_index] == _PENDING and self.last_seen[block_index] == last_seen:
+                self.set_free(block_index)
+
+    def get_next_expiry(self, timeout=PENDING_TIMEOUT):
+        # time the oldest pending block expires, None without pending blocks
+        if not self.pending:
+            return None
+        return self.pending[0][0] + timeout
+
+    def is_piece_full(self, piece_index):
+        start, end = self.get_piece_range(piece_index)
+        return self.full_blocks[piece_index] == end - start
+
+    def has_unfull_blocks(self, start=0, end=None):
+        if end is None:
+            end = self.number_of_blocks
+        return self.states.count(_FULL, start, end) < end - start
+
+    def set_piece_full(self, piece_index):
+        start, end = self.get_piece_range(piece_index)
+        self.states[start:end] = bytes([_FULL]) * (end - start)
+        self.full_blocks[piece_index] = end - start
+
+    def reset_piece(self, piece_index):
+        start, end = self.get_piece_range(piece_index)
+        self.states[start:end] = bytes(end - start)
+        self.full_blocks[piece_index] = 0
+        self.free_cursor = min(self.free_cursor, start)
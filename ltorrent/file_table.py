@@ -0,0 +1,76 @@
+__author__ = 'L-ING'
+
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+
+# part of a file covered by a range of the torrent data:
+# data[data_offset:data_offset + length] is stored at file_offset in path
+FileSpan = namedtuple('FileSpan', ['path', 'file_offset', 'data_offset', 'length'])
+
+
+class FileTable(object):
+    """
+    Offsets of the files of the torrent, seen as the concatenation of its files:
+
+    - offsets = offset of every file in the torrent data, followed by the total length (array of unsigned long longs)
+    - selected = 1 for every selected file (bytearray)
+
+    Spans are computed on demand, a range is located by bisecting the offsets.
+    """
+
+    def __init__(self, file_names: list, selection, piece_length: int):
+        self.file_names: list = file_names
+        self.number_of_files: int = len(file_names)
+        self.piece_length: int = piece_length
+
+        self.offsets = array('Q', bytes(8 * (self.number_of_files + 1)))
+        offset = 0
+        for file_id, file in enumerate(file_names):
+            self.offsets[file_id] = offset
+            offset += file['length']
+        self.offsets[self.number_of_files] = offset
+        self.total_length: int = offset
+
+        self.selected = bytearray(self.number_of_files)
+        for file_id in selection:
+            self.selected[file_id] = 1
+
+    def get_file_range(self, file_id):
+        return self.offsets[file_id], self.offsets[file_id + 1]
+
+    def get_spans(self, offset, length):
+        # spans of the selected files covering data[offset:offset + length]
+        spans = []
+        end = offset + length
+        file_id = bisect_right(self.offsets, offset, 0, self.number_of_files) - 1
+
+        while file_id < self.number_of_files and self.offsets[file_id] < end:
+            file_start, file_end = self.get_file_range(file_id)
+            start = max(offset, file_start)
+            stop = min(end, file_end)
+
+            if stop > start and self.selected[file_id]:
+                spans.append(FileSpan(
+                    path=self.file_names[file_id]['path'],
+                    file_offset=start - file_start,
+                    data_offset=start - offset,
+                    length=stop - start
+                ))
+
+            file_id += 1
+
+        return spans
+
+    def get_piece_spans(self, piece_index, piece_offset=0, length=None):
+        offset = piece_index * self.piece_length + piece_offset
+        if length is None:
+            length = min(self.piece_length, self.total_length - offset)
+        return self.get_spans(offset, length)
+
+    def get_selected_piece_ranges(self):
+        # (first piece, last piece) covered by every selected file, empty files cover none
+        for file_id in range(self.number_of_files):
+            file_start, file_end = self.get_file_range(file_id)
+            if self.selected[file_id] and file_end > file_start:
+                yield file_start // self.piece_length, (file_end - 1) // self.piece_length
@@ -1,17 +1,36 @@
 __author__ = 'alexisgallepe, L-ING'
 
+import math
 import time
 import socket
 import struct
 import bitstring
+from threading import Lock
 from ltorrent.message import (
     WrongMessageException,
     UnChoke,
     Interested,
     Handshake,
+    Request,
+    Cancel,
     KeepAlive,
     MessageDispatcher
 )
+from ltorrent.block import BLOCK_SIZE, PENDING_TIMEOUT
+
+# bounds of the adaptive request queue depth
+MIN_QUEUE_DEPTH = 2
+MAX_QUEUE_DEPTH = 256
+# seconds over which the download rate is measured
+RATE_WINDOW = 1
+# seconds of transfer kept requested on top of the round trip
+REQUEST_QUEUE_TIME = 1
+# bytes read from the socket at once, the read buffer is compacted when less is free at its end
+READ_SIZE = 65536
+# initial size of the read buffer
+READ_BUFFER_SIZE = 4 * READ_SIZE
+# unsent bytes above which no more requests or uploads are queued for a peer
+WRITE_BUFFER_LIMIT = 262144
 
 
 class Peer(object):
@@ -19,7 +38,14 @@ class Peer(object):
         self.last_call = 0.0
         self.has_handshaked = False
         self.healthy = False
-        self.read_buffer = b''
+        # received data is read_buffer[read_start:read_end], parsed in place and compacted only when full
+        self.read_buffer = bytearray(READ_BUFFER_SIZE)
+        self.read_start = 0
+        self.read_end = 0
+        # messages not sent yet, sent on flush or when the socket is writable again
+        self.write_buffer = bytearray()
+        self.write_lock = Lock()
+        self.is_writing = False
         self.socket = None
         self.ip = ip
         self.peers_manager = peers_manager
@@ -35,6 +61,14 @@ class Peer(object):
             'peer_interested': False,
         }
         self.timeout_num = 0
+        # (piece index, block offset) -> time the block was requested, not received yet
+        self.pending_requests = {}
+        self.queue_depth = peers_manager.queue_depth
+        self.adaptive_queue_depth = peers_manager.adaptive_queue_depth
+        self.min_rtt = 0.0
+        self.download_rate = 0.0
+        self.rate_window_start = time.time()
+        self.rate_window_size = 0
 
     def __hash__(self):
         return "%s:%d" % (self.ip, self.port)
@@ -60,10 +94,58 @@ class Peer(object):
 
         return True
 
-    def send_to_peer(self, msg):
+    def send_to_peer(self, msg, flush=True):
+        # messages are queued in write_buffer, flush=False leaves them for the next PeersManager.flush_peers()
+        with self.write_lock:
+            self.write_buffer += msg
+            if not flush:
+                self.peers_manager.add_unflushed_peer(self)
+                return
+            self._flush()
+
+    def flush(self):
+        with self.write_lock:
+            self._flush()
+
+    def _flush(self):
+        # one send for everything queued, the rest waits for the socket to be writable
+        if self.is_writing or not self.write_buffer:
+            return
+
+        sent = self._send(self.write_buffer)
+        if sent:
+            del self.write_buffer[:sent]
+        if self.write_buffer and self.healthy:
+            self.is_writing = True
+            self.peers_manager.set_write_interest(self, True)
+
+    def handle_write(self):
+        with self.write_lock:
+            was_blocked = self.is_write_blocked()
+            self.is_writing = False
+            self._flush()
+            if not self.is_writing:
+                self.peers_manager.set_write_interest(self, False)
+
+        if was_blocked and not self.is_write_blocked():
+            self.peers_manager.notify_requests()
+
+    def has_pending_writes(self):
+        return len(self.write_buffer) > 0
+
+    def is_write_blocked(self):
+        # backpressure, the peer does not read as fast as we write
+        return len(self.write_buffer) >= WRITE_BUFFER_LIMIT
+
+    def _send(self, data):
+        # number of bytes the socket took, None if the peer is gone
         try:
-            self.socket.send(msg)
+            sent = self.socket.send(data)
             self.last_call = time.time()
+            return sent
+        except BlockingIOError:
+            # the socket buffer is full
+            return 0
         except BrokenPipeError:
             self.healthy = False
             self.stdout.WARNING("Broken pipe. Sending message to a closed peer.")
@@ -74,9 +156,78 @@ class Peer(object):
             self.healthy = False
             self.stdout.ERROR("Failed to send to peer:", e)
 
-    def is_eligible(self):
+    def request_block(self, piece_index, block_offset, block_length):
+        request = Request(
+            piece_index=piece_index,
+            block_offset=block_offset,
+            block_length=block_length
+        ).to_bytes()
+        self.send_to_peer(msg=request, flush=False)
+
         now = time.time()
-        return (now - self.last_call) > 0.1
+        if not self.pending_requests:
+            # the peer was idle, only measure the rate while blocks are requested
+            self.rate_window_start = now
+            self.rate_window_size = 0
+        self.pending_requests[(piece_index, block_offset)] = now
+
+    def cancel_block(self, piece_index, block_offset, block_length):
+        cancel = Cancel(
+            piece_index=piece_index,
+            block_offset=block_offset,
+            block_length=block_length
+        ).to_bytes()
+        self.send_to_peer(msg=cancel, flush=False)
+        self.pending_requests.pop((piece_index, block_offset), None)
+
+    def can_request(self):
+        if self.is_write_blocked():
+            return False
+
+        if len(self.pending_requests) < self.queue_depth:
+            return True
+
+        self.expire_requests()
+        return len(self.pending_requests) < self.queue_depth
+
+    def expire_requests(self):
+        # requests unanswered for too long are given up, their blocks are set free by the pieces manager
+        deadline = time.time() - PENDING_TIMEOUT
+        expired_keys = [key for key, request_time in list(self.pending_requests.items()) if request_time < deadline]
+        for key in expired_keys:
+            self.pending_requests.pop(key, None)
+        self.peers_manager.remove_endgame_requests(self, expired_keys)
+
+    def update_download_rate(self, block_length, request_time=None):
+        # moving average over RATE_WINDOW of the bytes received
+        now = time.time()
+        if request_time:
+            rtt = now - request_time
+            if not self.min_rtt or rtt < self.min_rtt:
+                self.min_rtt = rtt
+
+        self.rate_window_size += block_length
+        if now - self.rate_window_start < RATE_WINDOW:
+            return
+
+        rate = self.rate_window_size / (now - self.rate_window_start)
+        self.download_rate = (self.download_rate + rate) / 2 if self.download_rate else rate
+        self.rate_window_start = now
+        self.rate_window_size = 0
+
+        if self.adaptive_queue_depth:
+            # bandwidth-delay product, the delay covering the round trip and the time to refill the queue
+            queue_size = self.download_rate * (self.min_rtt + REQUEST_QUEUE_TIME)
+            self.queue_depth = max(MIN_QUEUE_DEPTH, min(MAX_QUEUE_DEPTH, math.ceil(queue_size / BLOCK_SIZE)))
+
+    def get_download_rate(self):
+        # bytes per second, including the window being measured
+        elapsed = time.time() - self.rate_window_start
+        if elapsed < RATE_WINDOW:
+            return self.download_rate
+
+        rate = self.rate_window_size / elapsed
+        return (self.download_rate + rate) / 2 if self.download_rate else rate
 
     def has_piece(self, index):
         return self.bit_field[index]
@@ -102,10 +253,16 @@ class Peer(object):
     def handle_choke(self):
         self.stdout.DEBUG('handle_choke - %s' % self.ip)
         self.state['peer_choking'] = True
+        # a choking peer discards the requests it has not answered
+        self.peers_manager.remove_endgame_requests(self, list(self.pending_requests))
+        self.pending_requests.clear()
+        self.peers_manager.update_peer_index(self)
 
     def handle_unchoke(self):
         self.stdout.DEBUG('handle_unchoke - %s' % self.ip)
         self.state['peer_choking'] = False
+        self.peers_manager.update_peer_index(self)
+        self.peers_manager.notify_requests()
 
     def handle_interested(self):
         self.stdout.DEBUG('handle_interested - %s' % self.ip)
@@ -113,7 +270,7 @@ class Peer(object):
 
         if self.am_choking():
             unchoke = UnChoke().to_bytes()
-            self.send_to_peer(msg=unchoke)
+            self.send_to_peer(msg=unchoke, flush=False)
 
     def handle_not_interested(self):
         self.stdout.DEBUG('handle_not_interested - %s' % self.ip)
@@ -124,11 +281,15 @@ class Peer(object):
         :type have: message.Have
         """
         self.stdout.DEBUG('handle_have - ip: %s - piece: %s' % (self.ip, have.piece_index))
-        self.bit_field[have.piece_index] = True
+        if not self.bit_field[have.piece_index]:
+            self.bit_field[have.piece_index] = True
+            self.pieces_manager.add_peer_piece(have.piece_index)
+            self.peers_manager.add_peer_index_piece(self, have.piece_index)
+            self.peers_manager.notify_requests()
 
         if self.is_choking() and not self.state['am_interested']:
             interested = Interested().to_bytes()
-            self.send_to_peer(mgs=interested)
+            self.send_to_peer(msg=interested, flush=False)
             self.state['am_interested'] = True
 
     def handle_bitfield(self, bitfield):
@@ -136,11 +297,16 @@ class Peer(object):
         :type bitfield: message.BitField
         """
         self.stdout.DEBUG('handle_bitfield - %s - %s' % (self.ip, bitfield.bitfield))
+        self.peers_manager.remove_peer_index(self)
+        self.pieces_manager.remove_peer_bitfield(self.bit_field)
         self.bit_field = bitfield.bitfield
+        self.pieces_manager.add_peer_bitfield(self.bit_field)
+        self.peers_manager.update_peer_index(self)
+        self.peers_manager.notify_requests()
 
         if self.is_choking() and not self.state['am_interested']:
             interested = Interested().to_bytes()
-            self.send_to_peer(msg=interested)
+            self.send_to_peer(msg=interested, flush=False)
             self.state['am_interested'] = True
 
     def handle_request(self, request):
@@ -155,18 +321,20 @@ class Peer(object):
         """
         :type message: message.Piece
         """
-        if self.pieces_manager.sequential:
-            self.pieces_manager.receive_block_piece_seq(
-                piece_index=message.piece_index,
-                piece_offset=message.block_offset,
-                piece_data=message.block
-            )
-        else:
-            self.pieces_manager.receive_block_piece(
-                piece_index=message.piece_index,
-                piece_offset=message.block_offset,
-                piece_data=message.block
-            )
+        self.pieces_manager.receive_block_piece(
+            piece_index=message.piece_index,
+            piece_offset=message.block_offset,
+            piece_data=message.block
+        )
+        request_time = self.pending_requests.pop((message.piece_index, message.block_offset), None)
+        self.update_download_rate(len(message.block), request_time)
+        self.peers_manager.cancel_endgame_requests(
+            piece_index=message.piece_index,
+            block_offset=message.block_offset,
+            block_length=message.block_length,
+            peer=self
+        )
+        self.peers_manager.notify_requests()
 
     def handle_cancel(self):
         self.stdout.DEBUG('handle_cancel - %s' % self.ip)
@@ -174,11 +342,51 @@ class Peer(object):
     def handle_port_request(self):
         self.stdout.DEBUG('handle_port_request - %s' % self.ip)
 
-    def _handle_handshake(self):
+    def _compact_read_buffer(self):
+        # move the unparsed data to the front, into a larger buffer if it still lacks room for a read
+        size = self.read_end - self.read_start
+        if len(self.read_buffer) - size < READ_SIZE:
+            # a new buffer rather than a resize, a received block may still be viewing the old one
+            read_buffer = bytearray(len(self.read_buffer) + max(READ_SIZE, len(self.read_buffer)))
+            read_buffer[:size] = self.read_buffer[self.read_start:self.read_end]
+            self.read_buffer = read_buffer
+        elif self.read_start:
+            self.read_buffer[:size] = self.read_buffer[self.read_start:self.read_end]
+        self.read_start = 0
+        self.read_end = size
+
+    def read_from_socket(self):
+        # recv_into the free end of the read buffer until the socket is drained, returns the number of bytes read
+        received = 0
+        while True:
+            if len(self.read_buffer) - self.read_end < READ_SIZE:
+                self._compact_read_buffer()
+
+            try:
+                with memoryview(self.read_buffer) as buffer:
+                    size = self.socket.recv_into(buffer[self.read_end:])
+            except socket.timeout:
+                self.stdout.WARNING("Read from socket timeout in Peer")
+                break
+            except BlockingIOError:
+                # Resource temporarily unavailable
+                break
+
+            if not size:
+                # closed by the peer
+                self.healthy = False
+                break
+
+            self.read_end += size
+            received += size
+
+        return received
+
+    def _handle_handshake(self, buffer):
         try:
-            handshake_message = Handshake.from_bytes(payload=self.read_buffer)
+            handshake_message = Handshake.from_bytes(payload=buffer[self.read_start:self.read_end])
             self.has_handshaked = True
-            self.read_buffer = self.read_buffer[handshake_message.total_length:]
+            self.read_start += handshake_message.total_length
             self.stdout.DEBUG('handle_handshake - %s' % self.ip)
             return True
 
@@ -188,37 +396,41 @@ class Peer(object):
 
         return False
 
-    def _handle_keep_alive(self):
+    def _handle_keep_alive(self, buffer):
         try:
-            keep_alive = KeepAlive.from_bytes(payload=self.read_buffer)
+            keep_alive = KeepAlive.from_bytes(payload=buffer[self.read_start:self.read_end])
             self.stdout.DEBUG('handle_keep_alive - %s' % self.ip)
         except WrongMessageException:
             # try to handle keep alive message in every loop
             return False
         except Exception as e:
-            self.stdout.ERROR("Error KeepALive, need at least 4 bytes, but got %d bytes:" % len(self.read_buffer), e)
+            self.stdout.ERROR("Error KeepALive, need at least 4 bytes, but got %d bytes:" % (self.read_end - self.read_start), e)
             return False
 
-        self.read_buffer = self.read_buffer[keep_alive.total_length:]
+        self.read_start += keep_alive.total_length
         return True
 
     def get_messages(self):
-        while len(self.read_buffer) > 4 and self.healthy:
-            if (not self.has_handshaked and self._handle_handshake()) or self._handle_keep_alive():
-                continue
-
-            payload_length, = struct.unpack(">I", self.read_buffer[:4])
-            total_length = payload_length + 4
-
-            if len(self.read_buffer) < total_length:
-                break
-            else:
-                payload = self.read_buffer[:total_length]
-                self.read_buffer = self.read_buffer[total_length:]
-
-            try:
-                received_message = MessageDispatcher(payload=payload, stdout=self.stdout).dispatch()
-                if received_message:
-                    yield received_message
-            except WrongMessageException as e:
-                self.stdout.ERROR("Wrong message received in peer.Peer.get_messages:", e)
+        with memoryview(self.read_buffer) as buffer:
+            while self.read_end - self.read_start > 4 and self.healthy:
+                if (not self.has_handshaked and self._handle_handshake(buffer)) or self._handle_keep_alive(buffer):
+                    continue
+
+                payload_length, = struct.unpack_from(">I", buffer, self.read_start)
+                total_length = payload_length + 4
+
+                if self.read_end - self.read_start < total_length:
+                    break
+                else:
+                    payload = buffer[self.read_start:self.read_start + total_length]
+                    self.read_start += total_length
+
+                try:
+                    received_message = MessageDispatcher(payload=payload, stdout=self.stdout).dispatch()
+                    if received_message:
+                        yield received_message
+                except WrongMessageException as e:
+                    self.stdout.ERROR("Wrong message received in peer.Peer.get_messages:", e)
+
+        if self.read_start == self.read_end:
+            self.read_start = self.read_end = 0
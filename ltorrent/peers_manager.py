@@ -1,6 +1,6 @@
 __author__ = 'alexisgallepe, L-ING'
 
-import select
+import selectors
 from threading import Thread, BoundedSemaphore
 import socket
 import random
@@ -35,6 +35,8 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 THREAD_MAX_NUM = 10
 THREAD_SEMA = BoundedSemaphore(THREAD_MAX_NUM)
+# peers asked for the same block in endgame mode
+ENDGAME_MAX_PEERS = 3
 
 
 class SockAddr:
@@ -51,6 +53,12 @@ class PeersPool:
     dict_sock_addr = {}
     connected_peers = {}
 
+    def add_peer(self, peer):
+        self.connected_peers[peer.__hash__()] = peer
+
+    def remove_peer(self, peer_hash):
+        return self.connected_peers.pop(peer_hash, None)
+
 
 class HTTPScraper(Thread):
     def __init__(self, torrent, tracker, peers_pool, stdout, port=6881, timeout=2):
@@ -293,7 +301,7 @@ class PeersConnector(Thread):
             if not new_peer.connect(timeout=self.timeout) or not self.do_handshake(new_peer):
                 self.del_queue.put(new_peer.__hash__())
             else:
-                self.peers_pool.connected_peers[new_peer.__hash__()] = new_peer
+                self.peers_manager.add_peer(new_peer)
                 self.stdout.DEBUG("new peer added: ip: %s - port: %s" % (new_peer.ip, new_peer.port))
         except Exception as e:
             self.stdout.ERROR("Error in peers connector:", e)
@@ -377,8 +385,8 @@ class PeersScraper():
         
         for del_peer in self.queue.queue:
             try:
+                self.peers_pool.remove_peer(del_peer)
                 del self.peers_pool.dict_sock_addr[del_peer]
-                del self.peers_pool.connected_peers[del_peer]
             except:
                 continue
         
@@ -386,14 +394,29 @@ class PeersScraper():
 
 
 class PeersManager(Thread):
-    def __init__(self, torrent, pieces_manager, peers_pool, stdout):
+    def __init__(self, torrent, pieces_manager, peers_pool, stdout, queue_depth=16, adaptive_queue_depth=False):
         Thread.__init__(self)
         self.torrent = torrent
         self.pieces_manager = pieces_manager
         self.peers_pool = peers_pool
-        self.pieces_by_peer = [[0, []] for _ in range(pieces_manager.number_of_pieces)]
+        # outstanding block requests per peer
+        self.queue_depth = queue_depth
+        self.adaptive_queue_depth = adaptive_queue_depth
+        # (piece index, block offset) -> peers asked for the block in endgame mode
+        self.endgame_requests = {}
+        self.endgame_request_count = 0
+        self.endgame_cancel_count = 0
+        # piece index -> {"ip:port": peer} of the unchoked peers having the piece that we are interested in
+        self.peers_by_piece = [{} for _ in range(int(torrent.number_of_pieces))]
+        self.indexed_peers = {}
         self.is_active = True
         self.stdout = stdout
+        # "ip:port" -> peer having messages queued since the last flush
+        self.unflushed_peers = {}
+        # sockets of the connected peers, registered for writing only while they have unsent data
+        self.selector = selectors.DefaultSelector()
+        for peer in list(self.peers_pool.connected_peers.values()):
+            self.register_peer(peer)
 
     def peer_requests_piece(self, request=None, peer=None):
         if not request or not peer:
@@ -401,6 +424,11 @@ class PeersManager(Thread):
 
         piece_index, block_offset, block_length = request.piece_index, request.block_offset, request.block_length
 
+        if peer.is_write_blocked():
+            # the peer will ask again, queuing more would only grow its send queue
+            self.stdout.DEBUG("Send queue full, dropped request of piece index {} from peer : {}".format(piece_index, peer.ip))
+            return
+
         block = self.pieces_manager.get_block(
             piece_index=piece_index,
             block_offset=block_offset,
@@ -413,15 +441,140 @@ class PeersManager(Thread):
                 block_offset=block_offset,
                 block=block
             ).to_bytes()
-            peer.send_to_peer(mgs=piece)
+            peer.send_to_peer(msg=piece)
             self.stdout.DEBUG("Sent piece index {} to peer : {}".format(request.piece_index, peer.ip))
 
-    def get_random_peer_having_piece(self, index):
+    def get_ready_peers(self):
+        # peers able to take more requests, fastest first, peers without a measured rate in random order
         ready_peers = []
-        for peer in self.peers_pool.connected_peers.values():
-            if peer.is_eligible() and peer.is_unchoked() and peer.am_interested() and peer.has_piece(index):
-                ready_peers.append(peer)
-        return random.choice(ready_peers) if ready_peers else None
+        for peer in list(self.indexed_peers.values()):
+            if peer.can_request():
+                ready_peers.append((peer.get_download_rate(), random.random(), peer))
+        ready_peers.sort(key=lambda item: item[:2], reverse=True)
+        return [peer for _, _, peer in ready_peers]
+
+    def get_download_rates(self):
+        # "ip:port" -> download rate in bytes per second of every connected peer
+        return {
+            peer_hash: peer.get_download_rate()
+            for peer_hash, peer in list(self.peers_pool.connected_peers.items())
+        }
+
+    def notify_requests(self):
+        self.pieces_manager.notify_requests()
+
+    def add_unflushed_peer(self, peer):
+        self.unflushed_peers[peer.__hash__()] = peer
+
+    def flush_peers(self):
+        # one send per peer for the messages queued since the last flush
+        while self.unflushed_peers:
+            try:
+                _, peer = self.unflushed_peers.popitem()
+            except KeyError:
+                break
+            peer.flush()
+
+    def add_peer(self, peer):
+        self.peers_pool.add_peer(peer)
+        self.register_peer(peer)
+        self.notify_requests()
+
+    def register_peer(self, peer):
+        events = selectors.EVENT_READ
+        if peer.has_pending_writes():
+            events |= selectors.EVENT_WRITE
+        try:
+            self.selector.register(peer.socket, events, peer)
+        except (KeyError, ValueError) as e:
+            self.stdout.WARNING("Failed to register peer socket:", e)
+
+    def unregister_peer(self, peer):
+        try:
+            self.selector.unregister(peer.socket)
+        except (KeyError, ValueError):
+            pass
+
+    def set_write_interest(self, peer, is_writing):
+        events = selectors.EVENT_READ
+        if is_writing:
+            events |= selectors.EVENT_WRITE
+        try:
+            self.selector.modify(peer.socket, events, peer)
+        except (KeyError, ValueError):
+            # not registered yet, register_peer will look at the unsent data
+            pass
+
+    def update_peer_index(self, peer):
+        # keep peers_by_piece in line with the choke and interest state of peer
+        peer_hash = peer.__hash__()
+        is_ready = peer.is_unchoked() and peer.am_interested() and peer_hash in self.peers_pool.connected_peers
+        if is_ready and peer_hash not in self.indexed_peers:
+            self.indexed_peers[peer_hash] = peer
+            for piece_index in peer.bit_field.findall('0b1'):
+                if piece_index < len(self.peers_by_piece):
+                    self.peers_by_piece[piece_index][peer_hash] = peer
+        elif not is_ready and peer_hash in self.indexed_peers:
+            self.remove_peer_index(peer)
+
+    def remove_peer_index(self, peer):
+        peer_hash = peer.__hash__()
+        if self.indexed_peers.pop(peer_hash, None) is None:
+            return
+
+        for piece_index in peer.bit_field.findall('0b1'):
+            if piece_index < len(self.peers_by_piece):
+                self.peers_by_piece[piece_index].pop(peer_hash, None)
+
+    def add_peer_index_piece(self, peer, piece_index):
+        peer_hash = peer.__hash__()
+        if peer_hash in self.indexed_peers and piece_index < len(self.peers_by_piece):
+            self.peers_by_piece[piece_index][peer_hash] = peer
+
+    def get_peers_having_piece(self, piece_index):
+        # unchoked peers having the piece, without scanning the connected peers
+        return list(self.peers_by_piece[piece_index].values())
+
+    def request_endgame_block(self, piece_index, block_offset, block_length):
+        # ask more peers for a block already in flight
+        key = (piece_index, block_offset)
+        requesters = self.endgame_requests.get(key)
+        if requesters is None:
+            requesters = [peer for peer in self.get_peers_having_piece(piece_index) if key in peer.pending_requests]
+            self.endgame_requests[key] = requesters
+
+        if len(requesters) >= ENDGAME_MAX_PEERS:
+            return
+
+        candidates = [
+            peer for peer in self.get_peers_having_piece(piece_index)
+            if peer not in requesters and key not in peer.pending_requests and peer.can_request()
+        ]
+        candidates.sort(key=lambda peer: peer.get_download_rate(), reverse=True)
+        for peer in candidates[:ENDGAME_MAX_PEERS - len(requesters)]:
+            peer.request_block(piece_index, block_offset, block_length)
+            requesters.append(peer)
+            self.endgame_request_count += 1
+
+    def remove_endgame_requests(self, peer, keys):
+        # peer won't answer these requests, other peers can be asked for the blocks
+        for key in keys:
+            requesters = self.endgame_requests.get(key)
+            if requesters and peer in requesters:
+                requesters.remove(peer)
+                if not requesters:
+                    self.endgame_requests.pop(key, None)
+
+    def cancel_endgame_requests(self, piece_index, block_offset, block_length, peer):
+        # the block arrived from peer, cancel it on the others
+        requesters = self.endgame_requests.pop((piece_index, block_offset), None)
+        if not requesters:
+            return
+
+        for other_peer in requesters:
+            if other_peer is not peer and (piece_index, block_offset) in other_peer.pending_requests:
+                other_peer.cancel_block(piece_index, block_offset, block_length)
+                self.endgame_cancel_count += 1
 
     def has_unchoked_peers(self):
         for peer in self.peers_pool.connected_peers.values():
@@ -436,73 +589,66 @@ class PeersManager(Thread):
                 cpt += 1
         return cpt
 
-    def _read_from_socket(self, sock):
-        data = b''
-
-        while True:
-            try:
-                buff = sock.recv(4096)
-                if len(buff) <= 0:
-                    break
-
-                data += buff
-            except socket.timeout:
-                self.stdout.WARNING("Read from socket timeout in PeersManager")
-                break
-            except BlockingIOError:
-                # Resource temporarily unavailable
-                # self.stdout.WARNING('Blocking IO in PeersManager:', e)
-                break
-
-        return data
-
     def run(self):
         while self.is_active:
             try:
-                read = [peer.socket for peer in self.peers_pool.connected_peers.values()]
-                read_list, _, _ = select.select(read, [], [], 1)
-
-                for socket in read_list:
-                    peer = self.get_peer_by_socket(socket)
-                    if not peer.healthy:
-                        self.remove_peer(peer=peer)
-                        continue
-
-                    try:
-                        payload = self._read_from_socket(socket)
-                        peer.timeout_num = 0
-                    except socket.timeout:
-                        peer.timeout_num += 1
-                        if peer.timeout_num > 5:
-                            self.stdout.WARNING("Peer too many timeout, removed")
-                            self.remove_peer(peer=peer)
-                        continue
-                    except ConnectionResetError:
-                        self.stdout.WARNING("Connection reset by peer in PeersManager")
-                        self.remove_peer(peer=peer)
-                        continue
-                    except OSError:
-                        self.stdout.WARNING("Socket closed in PeersManager")
-                        self.remove_peer(peer=peer)
-                        continue
-                    except Exception as e:
-                        self.stdout.ERROR("Error when read from socket in peers_manager.PeersManager:", e)
-                        self.remove_peer(peer=peer)
-                        continue
-
-                    peer.read_buffer += payload
-
-                    for message in peer.get_messages():
-                        self._process_new_message(new_message=message, peer=peer)
-            except ValueError as e:
-                self.stdout.ERROR("PeersManager is still running when updating peers.", e)
-                break
+                events = self.selector.select(1)
+
+                for key, mask in events:
+                    self._handle_peer_events(key.data, mask)
+
+                self.flush_peers()
             except Exception as e:
                 self.stdout.ERROR("Error when looping peers manager:", e)
                 break
 
+        self.selector.close()
+
+    def _handle_peer_events(self, peer, mask):
+        # a failing peer is removed, the others keep being served
+        try:
+            if not peer.healthy:
+                self.remove_peer(peer=peer)
+                return
+
+            if mask & selectors.EVENT_WRITE:
+                peer.handle_write()
+
+            if mask & selectors.EVENT_READ:
+                self._read_from_peer(peer)
+        except Exception as e:
+            self.stdout.ERROR("Error when handling peer %s, removed:" % peer.ip, e)
+            self.remove_peer(peer=peer)
+
+    def _read_from_peer(self, peer):
+        try:
+            peer.read_from_socket()
+            peer.timeout_num = 0
+        except socket.timeout:
+            peer.timeout_num += 1
+            if peer.timeout_num > 5:
+                self.stdout.WARNING("Peer too many timeout, removed")
+                self.remove_peer(peer=peer)
+            return
+        except ConnectionResetError:
+            self.stdout.WARNING("Connection reset by peer in PeersManager")
+            self.remove_peer(peer=peer)
+            return
+        except OSError:
+            self.stdout.WARNING("Socket closed in PeersManager")
+            self.remove_peer(peer=peer)
+            return
+        except Exception as e:
+            self.stdout.ERROR("Error when read from socket in peers_manager.PeersManager:", e)
+            self.remove_peer(peer=peer)
+            return
+
+        for message in peer.get_messages():
+            self._process_new_message(new_message=message, peer=peer)
+
     def remove_peer(self, peer):
-        if peer in self.peers_pool.connected_peers.values():
+        if self.peers_pool.connected_peers.get(peer.__hash__()) is peer:
+            self.unregister_peer(peer)
             try:
                 peer.socket.close()
             except BrokenPipeError as e:
@@ -510,13 +656,11 @@ class PeersManager(Thread):
             except Exception as e:
                 self.stdout.ERROR("Wrong when remove peer: %s" % e)
 
-            del self.peers_pool.connected_peers[peer.__hash__()]
-
-    def get_peer_by_socket(self, socket):
-        for peer in self.peers_pool.connected_peers.values():
-            if socket == peer.socket:
-                return peer
-        raise Exception("Peer not present in peer_list")
+            self.peers_pool.remove_peer(peer.__hash__())
+            self.remove_peer_index(peer)
+            self.remove_endgame_requests(peer, list(peer.pending_requests))
+            self.pieces_manager.remove_peer_bitfield(peer.bit_field)
+            self.notify_requests()
 
     def _process_new_message(self, new_message: Message, peer: Peer):
         if isinstance(new_message, Handshake) or isinstance(new_message, KeepAlive):
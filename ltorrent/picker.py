@@ -0,0 +1,109 @@
+__author__ = 'L-ING'
+
+from array import array
+
+# wanted pieces returned at once by get_rarest_pieces
+PICK_BATCH_SIZE = 32
+
+class PiecePicker(object):
+    """
+    Rarest first piece selection:
+
+    - availability = number of connected peers having each piece (array of unsigned ints)
+    - wanted = 1 for every active piece not yet completed (bytearray)
+    - buckets = wanted pieces grouped by availability, buckets[n] holds the pieces n peers have,
+      as {piece index: position in orders[n]}
+    - orders = pieces of each bucket in the order they entered it, entries of pieces which left
+      the bucket are skipped and dropped once they outnumber the pieces still in it
+
+    Counts are updated incrementally from bitfield, have and peer removal,
+    so picking a piece never rescans the peers, and buckets are walked
+    from a position rather than copied.
+    """
+
+    def __init__(self, number_of_pieces: int):
+        self.number_of_pieces: int = number_of_pieces
+        self.availability = array('I', bytes(4 * number_of_pieces))
+        self.wanted = bytearray(number_of_pieces)
+        self.buckets = [{}]
+        self.orders = [[]]
+
+    def _move(self, piece_index, old_availability, new_availability):
+        if not self.wanted[piece_index]:
+            return
+
+        self._remove_from_bucket(piece_index, old_availability)
+        while len(self.buckets) <= new_availability:
+            self.buckets.append({})
+            self.orders.append([])
+
+        order = self.orders[new_availability]
+        self.buckets[new_availability][piece_index] = len(order)
+        order.append(piece_index)
+
+    def _remove_from_bucket(self, piece_index, availability):
+        bucket = self.buckets[availability]
+        if bucket.pop(piece_index, None) is None:
+            return
+
+        order = self.orders[availability]
+        if len(order) > 2 * len(bucket) + PICK_BATCH_SIZE:
+            # drop the entries of pieces which left the bucket, a walk in progress may skip some pieces
+            order[:] = [index for position, index in enumerate(order) if bucket.get(index) == position]
+            for position, index in enumerate(order):
+                bucket[index] = position
+
+    def add_wanted(self, piece_index):
+        if self.wanted[piece_index]:
+            return
+
+        self.wanted[piece_index] = 1
+        self._move(piece_index, 0, self.availability[piece_index])
+
+    def remove_wanted(self, piece_index):
+        if not self.wanted[piece_index]:
+            return
+
+        self._remove_from_bucket(piece_index, self.availability[piece_index])
+        self.wanted[piece_index] = 0
+
+    def add_piece(self, piece_index):
+        if piece_index >= self.number_of_pieces:
+            return
+
+        availability = self.availability[piece_index]
+        self.availability[piece_index] = availability + 1
+        self._move(piece_index, availability, availability + 1)
+
+    def remove_piece(self, piece_index):
+        if piece_index >= self.number_of_pieces or not self.availability[piece_index]:
+            return
+
+        availability = self.availability[piece_index]
+        self.availability[piece_index] = availability - 1
+        self._move(piece_index, availability, availability - 1)
+
+    def add_bitfield(self, bitfield):
+        for piece_index in bitfield.findall('0b1'):
+            self.add_piece(piece_index)
+
+    def remove_bitfield(self, bitfield):
+        for piece_index in bitfield.findall('0b1'):
+            self.remove_piece(piece_index)
+
+    def get_rarest_pieces(self, availability, position=0):
+        # (up to PICK_BATCH_SIZE wanted pieces availability peers have, position to continue from),
+        # an empty list at the end of the bucket, None past the most available pieces
+        if availability >= len(self.buckets):
+            return None
+
+        bucket = self.buckets[availability]
+        order = self.orders[availability]
+        piece_index_list = []
+        while position < len(order) and len(piece_index_list) < PICK_BATCH_SIZE:
+            piece_index = order[position]
+            if bucket.get(piece_index) == position:
+                piece_index_list.append(piece_index)
+            position += 1
+
+        return piece_index_list, position
@@ -1,18 +1,24 @@
 __author__ = 'alexisgallepe, L-ING'
 
-import math
+import hashlib
 import bitstring
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Event
 from ltorrent.piece import Piece
-from ltorrent.block import State
+from ltorrent.block import BlockTable
+from ltorrent.file_table import FileTable
+from ltorrent.picker import PiecePicker
 
-# 8 * 1024 * 1024
-GROUP_MAX_SIZE = 8388608
+# 8 * 1024 * 1024, data ahead of the write cursor requested in sequential mode
+SEQUENTIAL_WINDOW_SIZE = 8388608
+# 8 * 1024 * 1024, size of one storage read when rechecking
+RECHECK_READ_SIZE = 8388608
 
 class ExitSelectionException(Exception):
     pass
 
 class PiecesManager(object):
-    def __init__(self, torrent, selection, storage, stdout, sequential=False):
+    def __init__(self, torrent, selection, storage, stdout, sequential=False, hash_workers=1):
         self.torrent = torrent
         self.number_of_pieces = int(torrent.number_of_pieces)
         self.bitfield = bitstring.BitArray(self.number_of_pieces)
@@ -20,19 +26,55 @@ class PiecesManager(object):
         self.stdout = stdout
         self.sequential = sequential
         self.pieces = self._generate_pieces()
-        self.group_pieces_num = GROUP_MAX_SIZE // self.pieces[0].piece_size
-        self.number_of_group = math.ceil(self.number_of_pieces / self.group_pieces_num)
+        self.block_table = BlockTable(
+            number_of_pieces=self.number_of_pieces,
+            piece_size=self.pieces[0].piece_size,
+            last_piece_size=self.pieces[-1].piece_size
+        )
+        # sequential mode: pieces before write_cursor are written in order,
+        # only the window_pieces pieces from write_cursor on and the priority pieces are requested,
+        # priority pieces being written as soon as they are verified
+        self.window_pieces = max(1, SEQUENTIAL_WINDOW_SIZE // self.pieces[0].piece_size)
+        self.write_cursor = 0
         self.selection = selection
+        self.file_table = FileTable(
+            file_names=torrent.file_names,
+            selection=selection,
+            piece_length=torrent.piece_length
+        )
         self.total_active_size = 0
-        self.files = self._load_files()
+        self._load_active_pieces()
         self.number_of_active_pieces = self.get_active_pieces_num()
         self.completed_pieces = 0
         self.completed_size = 0
+        # bytes hashed before the last block of their piece arrived, and after
+        self.early_hashed_size = 0
+        self.completion_hashed_size = 0
+        # guards the block table and piece states shared with hash workers
+        self.lock = Lock()
+        # held while writing the pieces at the write cursor, they are written by one thread at a time
+        self.write_lock = Lock()
+        # set whenever requests may be sent: unchoke, block received, new pieces or peers, piece completed
+        self.request_event = Event()
+        # set and replaced whenever a piece is written, see wait_for_pieces
+        self.written_event = Event()
+        # stream or request -> (first piece, last piece) requested before any other piece
+        self.priority_ranges = {}
+        # selected files created by allocating them, holding no data of a previous run
+        self.created_paths = set()
+        if hash_workers > 0:
+            self.hash_executor = ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix='PieceHasher')
+        else:
+            self.hash_executor = None
 
-        for file in self.files:
-            if file['fileId'] in self.selection:
-                id_piece = file['idPiece']
-                self.pieces[id_piece].files.append(file)
+        self.picker = PiecePicker(number_of_pieces=self.number_of_pieces)
+
+        # inactive pieces are never requested
+        for piece in self.pieces:
+            if piece.is_active:
+                self.picker.add_wanted(piece.piece_index)
+            else:
+                self.block_table.set_piece_full(piece.piece_index)
 
     def get_active_pieces_num(self):
         count = 0
@@ -41,131 +83,378 @@ class PiecesManager(object):
                 count += 1
         return count
 
+    def restore_pieces(self, piece_index_list):
+        # mark pieces already verified and written in a previous run as full
+        piece_index_set = set(piece_index_list)
+
+        for piece_index in sorted(piece_index_set):
+            piece = self.pieces[piece_index]
+            piece.is_full = True
+            self.block_table.set_piece_full(piece_index)
+            self.bitfield[piece_index] = 1
+            self.picker.remove_wanted(piece_index)
+            self.completed_pieces += 1
+            self.completed_size += piece.piece_size
+
+        self._advance_write_cursor()
+
+        return len(piece_index_set)
+
+    def recheck(self, workers, piece_index_list=None):
+        # hash the data already in storage, or only the pieces of piece_index_list,
+        # returns (rechecked size, restored pieces)
+        missing_paths = set(self.created_paths)
+        for file_id in self.selection:
+            path = self.torrent.file_names[file_id]['path']
+            if not self.storage.exists(path):
+                missing_paths.add(path)
+
+        batches = self._get_recheck_batches(piece_index_list, missing_paths)
+        rechecked_size = sum(piece.piece_size for batch in batches for piece in batch)
+
+        valid_piece_index_list = []
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='PieceRechecker') as executor:
+            for piece_index_list in executor.map(self._recheck_batch, batches):
+                valid_piece_index_list.extend(piece_index_list)
+
+        with self.lock:
+            return rechecked_size, self.restore_pieces(valid_piece_index_list)
+
+    def _get_recheck_batches(self, piece_index_list=None, missing_paths=()):
+        # runs of consecutive pieces to check, read from storage at once,
+        # pieces of missing files can't be valid and are not read
+        piece_index_set = None if piece_index_list is None else set(piece_index_list)
+        batches = []
+        batch = []
+        batch_size = 0
+        for piece in self.pieces:
+            if (
+                not piece.is_active
+                or piece.is_full
+                or (piece_index_set is not None and piece.piece_index not in piece_index_set)
+                or (missing_paths and any(span.path in missing_paths for span in self.get_piece_spans(piece.piece_index)))
+            ):
+                if batch:
+                    batches.append(batch)
+                batch = []
+                batch_size = 0
+                continue
+
+            if batch and batch_size + piece.piece_size > RECHECK_READ_SIZE:
+                batches.append(batch)
+                batch = []
+                batch_size = 0
+
+            batch.append(piece)
+            batch_size += piece.piece_size
+
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    def _recheck_batch(self, batch):
+        batch_size = sum(piece.piece_size for piece in batch)
+        spans = self.get_piece_spans(batch[0].piece_index, 0, batch_size)
+
+        try:
+            data = self.storage.read(spans, batch_size)
+        except Exception as e:
+            self.stdout.ERROR("Error when rechecking pieces %d-%d:" % (batch[0].piece_index, batch[-1].piece_index), e)
+            return []
+
+        if data is None:
+            # the storage failed to read, it has logged why
+            return []
+
+        valid_piece_index_list = []
+        view = memoryview(data)
+        data_index = 0
+        for piece in batch:
+            if hashlib.sha1(view[data_index:data_index + piece.piece_size]).digest() == piece.piece_hash:
+                valid_piece_index_list.append(piece.piece_index)
+            data_index += piece.piece_size
+        view.release()
+
+        return valid_piece_index_list
+
     def update_bitfield(self, piece_index):
         self.bitfield[piece_index] = 1
+        with self.lock:
+            self.picker.remove_wanted(piece_index)
         self.pieces[piece_index].clear()
+        written_event, self.written_event = self.written_event, Event()
+        written_event.set()
 
     def receive_block_piece(self, piece_index, piece_offset, piece_data):
-        if self.pieces[piece_index].is_full:
+        if not 0 <= piece_index < self.number_of_pieces:
             return
 
-        self.pieces[piece_index].set_block(offset=piece_offset, data=piece_data)
+        piece = self.pieces[piece_index]
+        # a hash worker may be resetting or writing the piece at the same time
+        with self.lock:
+            if piece.is_full:
+                return
+            is_set = piece.set_block(offset=piece_offset, data=piece_data)
 
-        if self.pieces[piece_index].are_all_blocks_full():
-            if self.pieces[piece_index].set_to_full():
-                self.completed_pieces +=1
+        if is_set:
+            self.hash_piece(piece)
 
-    def receive_block_piece_seq(self, piece_index, piece_offset, piece_data):
-        group_index = piece_index // self.group_pieces_num
-        if self.pieces[piece_index].is_full:
+    def hash_piece(self, piece):
+        if not self.hash_executor:
+            self._hash_piece(piece)
             return
-        self.pieces[piece_index].set_block(offset=piece_offset, data=piece_data)
 
-        if self.is_group_full(group_index):
-            self.write_group(group_index)
+        with self.lock:
+            if piece.is_hashing:
+                return
+            piece.is_hashing = True
+
+        try:
+            self.hash_executor.submit(self._hash_piece, piece)
+        except RuntimeError:
+            # executor already shut down
+            piece.is_hashing = False
+
+    def _hash_piece(self, piece):
+        try:
+            while True:
+                hashed_size = piece.update_hash()
+
+                with self.lock:
+                    if piece.is_hashed():
+                        self.completion_hashed_size += hashed_size
+                        piece.is_hashing = False
+                        break
+
+                    self.early_hashed_size += hashed_size
+                    if not piece.can_update_hash():
+                        piece.is_hashing = False
+                        return
+
+            self._complete_piece(piece)
+            self.notify_requests()
+        except Exception as e:
+            piece.is_hashing = False
+            self.stdout.ERROR("Error when hashing piece %d:" % piece.piece_index, e)
+
+    def _complete_piece(self, piece):
+        if not piece._valid_blocks():
+            with self.lock:
+                piece._init_blocks()
+            return
 
-    def get_unfull_blocks(self):
-        block_list = []
-        for piece in self.pieces:
-            if not piece.is_active:
-                continue
-            if piece.is_full:
-                continue
-            for block_index, block in enumerate(piece.blocks):
-                if block.state == State.FULL:
-                    continue
-                block_list.append((piece, block_index, block))
-        return block_list
-
-    def get_group_unfull_blocks(self, group_index):
-        block_list = []
-        for piece in self.get_group_pieces(group_index):
-            if not piece.is_active:
-                continue
-            if piece.is_full:
-                continue
-            for block_index, block in enumerate(piece.blocks):
-                if block.state == State.FULL:
-                    continue
-                block_list.append((piece, block_index, block))
-        return block_list
-
-    def get_group_pieces(self, group_index):
-        return self.pieces[group_index * self.group_pieces_num : (group_index + 1) * self.group_pieces_num]
-
-    def valid_group_pieces(self, group_index):
-        for piece in self.get_group_pieces(group_index):
-            if piece.is_active and not piece.is_full and piece.are_all_blocks_full():
-                data = piece._merge_blocks()
-                if not piece._valid_blocks(piece_raw_data=data):
-                    piece._init_blocks()
-                    return False
-                piece.is_full = True
+        with self.lock:
+            piece.is_full = True
+
+        if not self.sequential:
+            piece.set_to_full()
+            with self.lock:
                 self.completed_pieces += 1
+            return
+
+        if self.is_priority_piece(piece.piece_index):
+            # a stream is waiting for the piece, write it now rather than when the window reaches it
+            with self.write_lock:
+                if not self.bitfield[piece.piece_index]:
+                    piece.set_to_full()
+                    with self.lock:
+                        self.completed_pieces += 1
+
+        self.write_window()
+
+    def close(self):
+        if self.hash_executor:
+            self.hash_executor.shutdown(wait=True)
+
+    def add_peer_bitfield(self, bitfield):
+        with self.lock:
+            self.picker.add_bitfield(bitfield)
+
+    def add_peer_piece(self, piece_index):
+        with self.lock:
+            self.picker.add_piece(piece_index)
+
+    def remove_peer_bitfield(self, bitfield):
+        with self.lock:
+            self.picker.remove_bitfield(bitfield)
+
+    def notify_requests(self):
+        self.request_event.set()
+
+    def update_block_status(self):  # if block is pending for too long : set it free
+        with self.lock:
+            self.block_table.expire_pending()
+
+    def get_request_pieces(self):
+        # pieces to request blocks of, in picking order: the priority pieces, then the nearest pieces
+        # in sequential mode or the rarest ones, some may have no free block left
+        for start, end in self.get_priority_block_ranges():
+            yield from self._get_range_free_pieces(start, end)
+
+        if self.sequential:
+            yield from self._get_range_free_pieces(*self.get_request_block_range())
+            return
+
+        # the buckets are walked a batch at a time, as far as the caller goes
+        availability = 1
+        position = 0
+        while True:
+            with self.lock:
+                rarest_pieces = self.picker.get_rarest_pieces(availability, position)
+            if rarest_pieces is None:
+                return
+
+            piece_index_list, position = rarest_pieces
+            if not piece_index_list:
+                availability += 1
+                position = 0
+            yield from piece_index_list
+
+    def _get_range_free_pieces(self, start, end):
+        # pieces having a free block between start and end
+        while True:
+            with self.lock:
+                block_index = self.block_table.next_free(start, end)
+            if block_index is None:
+                return
+
+            piece_index = block_index // self.block_table.blocks_per_piece
+            yield piece_index
+            start = self.block_table.get_piece_range(piece_index)[1]
+
+    def get_piece_free_block(self, piece_index):
+        with self.lock:
+            block_index = self.block_table.next_free(*self.block_table.get_piece_range(piece_index))
+            if block_index is None:
+                return None
+
+            self.block_table.set_pending(block_index)
+            return self.block_table.get_block_info(block_index)
+
+    def has_free_blocks(self, start=0, end=None):
+        with self.lock:
+            return self.block_table.next_free(start, end) is not None
+
+    def get_next_expiry(self):
+        with self.lock:
+            return self.block_table.get_next_expiry()
+
+    def get_pending_blocks(self, start=0, end=None):
+        with self.lock:
+            return [self.block_table.get_block_info(block_index) for block_index in self.block_table.get_pending_blocks(start, end)]
+
+    def set_priority(self, key, first_piece, last_piece):
+        # request the pieces from first_piece to last_piece before any other, until clear_priority(key)
+        with self.lock:
+            self.priority_ranges[key] = (max(first_piece, 0), min(last_piece, self.number_of_pieces - 1))
+        self.notify_requests()
+
+    def clear_priority(self, key):
+        with self.lock:
+            self.priority_ranges.pop(key, None)
+
+    def is_priority_piece(self, piece_index):
+        return any(first_piece <= piece_index <= last_piece for first_piece, last_piece in list(self.priority_ranges.values()))
+
+    def get_priority_block_ranges(self):
+        # block ranges of the priority pieces, nearest first
+        return [
+            (self.block_table.get_piece_range(first_piece)[0], self.block_table.get_piece_range(last_piece)[1])
+            for first_piece, last_piece in sorted(list(self.priority_ranges.values()))
+            if first_piece <= last_piece
+        ]
+
+    def get_deadline_block_ranges(self):
+        # block ranges of the first piece of every priority range, the one being waited for
+        return [
+            self.block_table.get_piece_range(first_piece)
+            for first_piece, last_piece in list(self.priority_ranges.values())
+            if first_piece <= last_piece
+        ]
+
+    def get_data_pieces(self, offset, length):
+        # (first piece, last piece) covering data[offset:offset + length] of the torrent
+        return offset // self.torrent.piece_length, (offset + max(length, 1) - 1) // self.torrent.piece_length
+
+    def has_pieces(self, first_piece, last_piece):
+        return self.bitfield[first_piece:last_piece + 1].all(True)
+
+    def wait_for_pieces(self, first_piece, last_piece, timeout=None):
+        # wait until the pieces are written, False on timeout
+        written_event = self.written_event
+        while not self.has_pieces(first_piece, last_piece):
+            if not written_event.wait(timeout):
+                return self.has_pieces(first_piece, last_piece)
+            written_event = self.written_event
+
         return True
 
-    def is_group_full(self, group_index):
-        if self.valid_group_pieces(group_index):
-            for piece in self.get_group_pieces(group_index):
-                if piece.is_active and not piece.is_full:
-                    return False
-            return True
-        else:
-            return False
+    def read_data(self, offset, length):
+        # data[offset:offset + length] of the selected files, from storage
+        return self.storage.read(self.file_table.get_spans(offset, length), length)
+
+    def get_request_block_range(self):
+        # blocks the requests are chosen from, the window in sequential mode
+        if not self.sequential:
+            return 0, None
+
+        end_piece = min(self.write_cursor + self.window_pieces, self.number_of_pieces)
+        if self.write_cursor >= end_piece:
+            return 0, 0
+        return self.block_table.get_piece_range(self.write_cursor)[0], self.block_table.get_piece_range(end_piece - 1)[1]
+
+    def _advance_write_cursor(self):
+        # skip the pieces not to write or already written
+        while self.write_cursor < self.number_of_pieces:
+            piece = self.pieces[self.write_cursor]
+            if piece.is_active and not self.bitfield[piece.piece_index]:
+                break
+            self.write_cursor += 1
+
+    def write_window(self):
+        # write the verified pieces at the write cursor in order, sliding the window past them
+        with self.write_lock:
+            while True:
+                self._advance_write_cursor()
+                pieces = self._get_write_run()
+                if not pieces:
+                    break
 
-    def write_group(self, group_index):
-        group_data = b''
-        group_file_list = []
-        data_index = 0
-        for piece in self.get_group_pieces(group_index):
-            if piece.is_active:
-                piece_data = piece._merge_blocks()
-                for piece_file in piece.files:
-                    if not self.is_piece_file_in_group_file_list(piece_file, group_file_list):
-                        group_file_list.append({
-                            'path': piece_file['path'],
-                            'fileOffset': piece_file["fileOffset"],
-                            'pieceOffset': data_index + piece_file['pieceOffset'],
-                            'length': 0
-                        })
-                    for group_file in group_file_list:
-                        if group_file['path'] == piece_file['path']:
-                            group_file['length'] += piece_file['length']
-                            break
-                self.update_bitfield(piece.piece_index)
-                group_data += piece_data
-            else:
-                group_data += b'0' * piece.piece_size
+                self._write_pieces(pieces)
+                for piece in pieces:
+                    self.update_bitfield(piece.piece_index)
+                    with self.lock:
+                        self.completed_pieces += 1
+                self.write_cursor += len(pieces)
 
-            data_index += piece.piece_size
+    def _get_write_run(self):
+        # the verified pieces following each other from the write cursor
+        pieces = []
+        piece_index = self.write_cursor
+        while piece_index < self.number_of_pieces:
+            piece = self.pieces[piece_index]
+            if not piece.is_active or self.bitfield[piece_index] or not piece.is_full:
+                break
+            pieces.append(piece)
+            piece_index += 1
+        return pieces
 
-        self.storage.write(group_file_list, group_data)
-        
-        for piece in self.get_group_pieces(group_index):
-            piece.clear()
-                    
-    def is_piece_file_in_group_file_list(self, piece_file, group_file_list):
-        for group_file in group_file_list:
-            if piece_file['path'] == group_file['path']:
-                return True
-        return False
+    def _write_pieces(self, pieces):
+        # one positioned write per file, straight from the piece buffers
+        offset = pieces[0].piece_index * self.torrent.piece_length
+        length = sum(piece.piece_size for piece in pieces)
+        self.storage.write_buffers(self.file_table.get_spans(offset, length), [piece.view for piece in pieces])
 
     def get_block(self, piece_index, block_offset, block_length):
-        for piece in self.pieces:
-            if piece_index == piece.piece_index:
-                if piece.is_full:
-                    return piece.get_block(block_offset=block_offset, block_length=block_length)
-                else:
-                    break
+        # only pieces already written can be read back
+        if 0 <= piece_index < self.number_of_pieces and self.bitfield[piece_index]:
+            return self.pieces[piece_index].get_block(block_offset=block_offset, block_length=block_length)
 
         return None
 
     def all_pieces_completed(self):
-        for piece in self.pieces:
-            if piece.is_active and not piece.is_full:
-                return False
-
-        return True
+        return self.completed_pieces >= self.number_of_active_pieces
 
     def _generate_pieces(self):
         pieces = []
@@ -197,52 +486,14 @@ class PiecesManager(object):
 
         return pieces
 
-    def _load_files(self):
-        files = []
-        piece_offset = 0
-        piece_size_used = 0
-        for i, f in enumerate(self.torrent.file_names):
-            current_size_file = f["length"]
-            file_offset = 0
-            is_active = 1
-            if i not in self.selection:
-                is_active = 0
-            while current_size_file > 0:
-                id_piece = piece_offset // self.torrent.piece_length
-                self.pieces[id_piece].is_active += is_active
-                piece_size = self.pieces[id_piece].piece_size - piece_size_used
-
-                if current_size_file - piece_size >= 0:
-                    current_size_file -= piece_size
-                    file = {
-                        "length": piece_size,
-                        "idPiece": id_piece,
-                        "fileOffset": file_offset,
-                        "pieceOffset": piece_size_used,
-                        "path": f["path"],
-                        'fileId': i
-                    }
-                    piece_offset += piece_size
-                    file_offset += piece_size
-                    piece_size_used = 0
-                else:
-                    file = {
-                        "length": current_size_file,
-                        "idPiece": id_piece,
-                        "fileOffset": file_offset,
-                        "pieceOffset": piece_size_used,
-                        "path": f["path"],
-                        'fileId': i
-                    }
-                    piece_offset += current_size_file
-                    file_offset += current_size_file
-                    piece_size_used += current_size_file
-                    current_size_file = 0
-
-                files.append(file)
+    def _load_active_pieces(self):
+        for first_piece, last_piece in self.file_table.get_selected_piece_ranges():
+            for piece_index in range(first_piece, last_piece + 1):
+                self.pieces[piece_index].is_active = True
 
         for piece in self.pieces:
             if piece.is_active:
                 self.total_active_size += piece.piece_size
 
-        return files
+    def get_piece_spans(self, piece_index, piece_offset=0, length=None):
+        return self.file_table.get_piece_spans(piece_index, piece_offset, length)
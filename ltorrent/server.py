@@ -0,0 +1,147 @@
+__author__ = 'L-ING'
+
+import os
+import re
+import mimetypes
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import quote, unquote
+from ltorrent.stream import FileStream, STREAM_READAHEAD
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header, length):
+    # (start, end) inclusive of a single "bytes=" range, None for the whole file, ValueError if unsatisfiable
+    if not header:
+        return None
+
+    match = RANGE_PATTERN.match(header.strip())
+    if not match:
+        # multiple ranges or another unit, answer with the whole file
+        return None
+
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # suffix range, the last bytes of the file
+        suffix = int(last)
+        if suffix == 0 or length == 0:
+            raise ValueError("Unsatisfiable range %s" % header)
+        return max(length - suffix, 0), length - 1
+
+    start = int(first)
+    end = int(last) if last else length - 1
+    if start >= length or end < start:
+        raise ValueError("Unsatisfiable range %s" % header)
+    return start, min(end, length - 1)
+
+
+class StreamRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serve a selected file at /<file_id>/<file name>, answering Range requests as the pieces are verified.
+    """
+
+    def do_HEAD(self):
+        self.handle_stream(send_body=False)
+
+    def do_GET(self):
+        self.handle_stream(send_body=True)
+
+    def handle_stream(self, send_body):
+        stream_server = self.server.stream_server
+        file_id = stream_server.get_file_id(self.path)
+        if file_id is None:
+            self.send_error(404)
+            return
+
+        stream = FileStream(client=stream_server.client, file_id=file_id, readahead=stream_server.readahead)
+        try:
+            try:
+                data_range = parse_range(self.headers.get('Range'), stream.length)
+            except ValueError:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % stream.length)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            if data_range is None:
+                start, end = 0, stream.length - 1
+                self.send_response(200)
+            else:
+                start, end = data_range
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, stream.length))
+
+            self.send_header('Content-Type', mimetypes.guess_type(stream.path)[0] or 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+
+            if not send_body:
+                return
+
+            stream.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = stream.read1(remaining)
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # the player closed the connection, e.g. to seek
+            pass
+        except Exception as e:
+            stream_server.client.stdout.ERROR("Stream of \"%s\" stopped:" % stream.path, e)
+        finally:
+            stream.close()
+
+    def log_message(self, format, *args):
+        self.server.stream_server.client.stdout.DEBUG("HTTP %s - %s" % (self.address_string(), format % args))
+
+
+class StreamServer(object):
+    """
+    Local HTTP server exposing every selected file of a client, usable while the torrent downloads:
+
+    - each request reads through a FileStream, so the requested range gets priority over the rest of the torrent
+    - the response is sent piece by piece as soon as each one is verified and written
+    """
+
+    def __init__(self, client, host='127.0.0.1', port=8000, readahead=STREAM_READAHEAD):
+        self.client = client
+        self.host = host
+        self.readahead = readahead
+
+        self.http_server = ThreadingHTTPServer((host, port), StreamRequestHandler)
+        self.http_server.daemon_threads = True
+        self.http_server.stream_server = self
+        self.port = self.http_server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.http_server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+    def get_url(self, file_id):
+        path = self.client.torrent.file_names[file_id]['path']
+        return 'http://%s:%d/%d/%s' % (self.host, self.port, file_id, quote(os.path.basename(path)))
+
+    def get_file_id(self, request_path):
+        # /<file_id>/<file name>, the name being only for players guessing the type from the url
+        parts = unquote(request_path.split('?')[0]).strip('/').split('/')
+        if not parts[0].isdigit():
+            return None
+
+        file_id = int(parts[0])
+        file_table = self.client.pieces_manager.file_table
+        if file_id >= file_table.number_of_files or not file_table.selected[file_id]:
+            return None
+        return file_id
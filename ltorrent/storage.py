@@ -1,6 +1,96 @@
 import os
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+from ltorrent.file_table import FileSpan
 from ltorrent.log import Logger
 
+# most buffers passed to one os.pwritev call
+IOV_MAX = 1024
+# most files kept open by Storage, the least recently used one is closed first
+MAX_OPEN_FILES = 64
+# allocation of the selected files before downloading:
+# none grows them as pieces are written, sparse sets their final size without allocating disk blocks,
+# full allocates all their disk blocks at once, keeping them contiguous where the file system can
+ALLOCATION_NONE = 'none'
+ALLOCATION_SPARSE = 'sparse'
+ALLOCATION_FULL = 'full'
+
+
+def get_span_buffers(buffers, buffer_offsets, data_offset, length):
+    # slices of buffers covering data[data_offset:data_offset + length], data being the buffers one after another
+    # and buffer_offsets the offset of every buffer in it
+    span_buffers = []
+    end = data_offset + length
+    buffer_index = bisect_right(buffer_offsets, data_offset) - 1
+    while data_offset < end:
+        buffer = buffers[buffer_index]
+        buffer_offset = buffer_offsets[buffer_index]
+        start = data_offset - buffer_offset
+        stop = min(len(buffer), end - buffer_offset)
+        span_buffers.append(buffer[start:stop])
+        data_offset += stop - start
+        buffer_index += 1
+    return span_buffers
+
+
+def get_buffer_offsets(buffers):
+    buffer_offsets = []
+    offset = 0
+    for buffer in buffers:
+        buffer_offsets.append(offset)
+        offset += len(buffer)
+    return buffer_offsets
+
+
+def pwrite(fd, data, offset):
+    # write all the data at offset, continuing after partial writes
+    view = memoryview(data)
+    while len(view):
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        offset += written
+        view = view[written:]
+
+
+def pread_into(fd, view, offset):
+    # fill view with the data at offset, leaving zeros after the end of the file
+    while len(view):
+        if hasattr(os, 'preadv'):
+            size = os.preadv(fd, [view], offset)
+        else:
+            data = os.pread(fd, len(view), offset)
+            size = len(data)
+            view[:size] = data
+        if not size:
+            break
+        offset += size
+        view = view[size:]
+
+
+def pwritev(fd, buffers, offset):
+    # write all the buffers at offset, continuing after partial writes
+    if not hasattr(os, 'pwritev'):
+        for buffer in buffers:
+            pwrite(fd, buffer, offset)
+            offset += len(buffer)
+        return
+
+    buffer_index = 0
+    while buffer_index < len(buffers):
+        written = os.pwritev(fd, buffers[buffer_index:buffer_index + IOV_MAX], offset)
+        offset += written
+        while buffer_index < len(buffers) and written >= len(buffers[buffer_index]):
+            written -= len(buffers[buffer_index])
+            buffer_index += 1
+        if written:
+            buffers[buffer_index] = buffers[buffer_index][written:]
+
+
 class StorageBase:
     def __init__(self):
         pass
@@ -11,16 +101,66 @@ class StorageBase:
     def create_sub_dir(self, path_file):
         pass
 
-    def write(self, file_piece_list, data):
+    def write(self, spans, data):
         raise Exception("CustomStorage.write not implemented")
 
-    def read(self, files, block_offset, block_length):
+    def write_buffers(self, spans, buffers):
+        # write data being the buffers one after another, without joining them
+        buffer_offsets = get_buffer_offsets(buffers)
+        for span in spans:
+            file_offset = span.file_offset
+            for buffer in get_span_buffers(buffers, buffer_offsets, span.data_offset, span.length):
+                self.write([FileSpan(path=span.path, file_offset=file_offset, data_offset=0, length=len(buffer))], buffer)
+                file_offset += len(buffer)
+
+    def read(self, spans, length):
         raise Exception("CustomStorage.read not implemented")
 
+    def stat(self, path):
+        # (size, mtime in ns) of a stored file, None if unknown
+        return None
+
+    def exists(self, path):
+        # False only if the file is known to be missing, its data is read otherwise
+        return True
+
+    def allocate(self, path, length):
+        # reserve the space of a selected file before it is downloaded
+        pass
+
+    def flush(self):
+        # make the written data durable, called before saving the resume file and when the download completes
+        pass
+
+    def close(self):
+        # release what is held open, called when the client stops
+        pass
+
 class Storage(StorageBase):
-    def __init__(self):
+    """
+    Files of the torrent on the local disk:
+
+    - descriptors are cached, up to max_open_files, closing the least recently used unused one first
+    - a descriptor is pinned while in use, the I/O itself runs outside the cache lock
+    - data is read and written with positioned I/O, so cached descriptors need no seek
+    - allocation = ALLOCATION_NONE, ALLOCATION_SPARSE or ALLOCATION_FULL, see allocate()
+    """
+
+    def __init__(self, max_open_files=MAX_OPEN_FILES, allocation=ALLOCATION_NONE):
         StorageBase.__init__(self)
+        if allocation not in (ALLOCATION_NONE, ALLOCATION_SPARSE, ALLOCATION_FULL):
+            raise Exception("Unknown allocation mode %s" % allocation)
+
         self.stdout = Logger()
+        self.max_open_files = max_open_files
+        self.allocation = allocation
+        # path -> [descriptor, writable, users]
+        self.files = OrderedDict()
+        # path -> number of the last write to it, for the paths written since their last fsync
+        self.dirty = {}
+        self.write_count = 0
+        # guards the cache, not the I/O
+        self.lock = Lock()
 
     def create_root_dir(self, root):
         if not os.path.exists(root):
@@ -30,44 +170,160 @@ class Storage(StorageBase):
         if not os.path.exists(path=os.path.dirname(path_file)):
             os.makedirs(name=os.path.dirname(path_file))
 
-    def write(self, file_piece_list, data):
-        for file in file_piece_list:
-            path_file = file["path"]
-            file_offset = file["fileOffset"]
-            piece_offset = file["pieceOffset"]
-            length = file["length"]
+    def stat(self, path):
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            return None
+        return file_stat.st_size, file_stat.st_mtime_ns
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    @contextmanager
+    def _open_fd(self, path, writable=False):
+        # descriptor of path, pinned in the cache until the block ends
+        entry = self._acquire_fd(path, writable)
+        try:
+            yield entry[0]
+        finally:
+            self._release_fd(path, entry)
+
+    def _acquire_fd(self, path, writable):
+        with self.lock:
+            entry = self.files.get(path)
+            if entry is not None and (entry[1] or not writable):
+                entry[2] += 1
+                self.files.move_to_end(path)
+                return entry
+
+            if entry is not None:
+                # opened for reading only, open it again to write
+                self._close_fd(path)
+
+            flags = getattr(os, 'O_BINARY', 0)
+            if writable:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT | flags, 0o666)
+            else:
+                try:
+                    fd = os.open(path, os.O_RDWR | flags)
+                except PermissionError:
+                    fd = os.open(path, os.O_RDONLY | flags)
+                    writable = None
+            entry = [fd, writable is not None, 1]
+            self.files[path] = entry
+            self._evict_fds()
 
+            return entry
+
+    def _release_fd(self, path, entry):
+        with self.lock:
+            entry[2] -= 1
+            if not entry[2] and self.files.get(path) is not entry:
+                # removed from the cache while in use
+                os.close(entry[0])
+            self._evict_fds()
+
+    def _evict_fds(self):
+        # descriptors in use stay open, the cache is trimmed again when they are released
+        for path in list(self.files):
+            if len(self.files) <= self.max_open_files:
+                break
+            if not self.files[path][2]:
+                self._close_fd(path)
+
+    def _close_fd(self, path):
+        entry = self.files.pop(path)
+        if not entry[2]:
+            os.close(entry[0])
+
+    def write(self, spans, data):
+        for path_file, file_offset, data_offset, length in spans:
             try:
-                f = open(path_file, 'r+b')  # Already existing file
-            except IOError:
-                f = open(path_file, 'wb')  # New file
-            except Exception as e:
+                with self._open_fd(path_file, writable=True) as fd:
+                    pwrite(fd, memoryview(data)[data_offset:data_offset + length], file_offset)
+                self._set_dirty(path_file)
+            except OSError as e:
                 self.stdout.ERROR("Can't write to file:", e)
                 return
 
-            f.seek(file_offset)
-            f.write(data[piece_offset:piece_offset + length])
-            f.close()
-
-    async def read(self, files, block_offset, block_length):
-        file_data_list = []
-        for file in files:
-            path_file = file["path"]
-            file_offset = file["fileOffset"]
-            piece_offset = file["pieceOffset"]
-            length = file["length"]
+    def write_buffers(self, spans, buffers):
+        buffer_offsets = get_buffer_offsets(buffers)
+        for span in spans:
+            span_buffers = get_span_buffers(buffers, buffer_offsets, span.data_offset, span.length)
+            try:
+                with self._open_fd(span.path, writable=True) as fd:
+                    pwritev(fd, span_buffers, span.file_offset)
+                self._set_dirty(span.path)
+            except OSError as e:
+                self.stdout.ERROR("Can't write to file:", e)
+                return
 
+    def read(self, spans, length):
+        data = bytearray(length)
+        view = memoryview(data)
+        for path_file, file_offset, data_offset, span_length in spans:
             try:
-                f = open(path_file, 'rb')
-            except Exception as e:
-                await self.stdout.ERROR("Can't read file %s:" % path_file, e)
+                with self._open_fd(path_file) as fd:
+                    pread_into(fd, view[data_offset:data_offset + span_length], file_offset)
+            except OSError as e:
+                self.stdout.ERROR("Can't read file %s:" % path_file, e)
                 return
 
-            f.seek(file_offset)
-            data = f.read(length)
-            file_data_list.append((piece_offset, data))
-            f.close()
+        view.release()
+        return data
+
+    def allocate(self, path, length):
+        # files already at their size are left as they are, keeping what a previous run wrote and its resume data
+        if self.allocation == ALLOCATION_NONE:
+            return
+
+        try:
+            with self._open_fd(path, writable=True) as fd:
+                if os.fstat(fd).st_size < length:
+                    if self.allocation == ALLOCATION_FULL and hasattr(os, 'posix_fallocate'):
+                        os.posix_fallocate(fd, 0, length)
+                    else:
+                        # sparse, or full where the platform can't allocate
+                        os.ftruncate(fd, length)
+        except OSError as e:
+            self.stdout.ERROR("Can't allocate file %s:" % path, e)
+
+    def _set_dirty(self, path):
+        with self.lock:
+            self.write_count += 1
+            self.dirty[path] = self.write_count
+
+    def flush(self):
+        # a path stays dirty until fsynced after its last write,
+        # every path is tried before the first error is raised
+        with self.lock:
+            dirty = list(self.dirty.items())
+
+        error = None
+        for path, write_count in dirty:
+            try:
+                self._fsync(path)
+            except OSError as e:
+                error = error or e
+                continue
+
+            self._set_clean(path, write_count)
+
+        if error:
+            raise error
+
+    def _fsync(self, path):
+        # files closed since they were written are opened again
+        with self._open_fd(path, writable=True) as fd:
+            os.fsync(fd)
+
+    def _set_clean(self, path, write_count):
+        with self.lock:
+            if self.dirty.get(path) == write_count:
+                del self.dirty[path]
 
-        file_data_list.sort(key=lambda x: x[0])
-        piece = b''.join([data for _, data in file_data_list])
-        return piece[block_offset : block_offset + block_length]
+    def close(self):
+        with self.lock:
+            for path in list(self.files):
+                self._close_fd(path)
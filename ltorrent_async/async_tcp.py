@@ -24,6 +24,19 @@ class AsyncTCPClient:
         else:
             raise Exception("AsyncTCPClient not connected yet.")
 
+    def write(self, msg):
+        # queue msg without waiting for it to be sent
+        if self.writer is not None:
+            self.writer.write(msg)
+        else:
+            raise Exception("AsyncTCPClient not connected yet.")
+
+    def get_write_buffer_size(self):
+        if self.writer is not None:
+            return self.writer.transport.get_write_buffer_size()
+        else:
+            return 0
+
     async def recv(self, buffer_size=-1):
         if self.reader is not None:
             # try:
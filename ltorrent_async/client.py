@@ -1,21 +1,29 @@
 __author__ = 'alexisgallepe, L-ING'
 
+import os
 import time
 import asyncio
 from ltorrent_async.peers_manager import PeersPool, PeersScraper, PeersManager
 from ltorrent_async.pieces_manager import PiecesManager
 from ltorrent_async.torrent import Torrent
-from ltorrent_async.block import State, BLOCK_SIZE
-from ltorrent_async.message import Request
 from ltorrent_async.log import Logger
 from ltorrent_async.storage import Storage
+from ltorrent_async.resume import Resume
+from ltorrent_async.stream import FileStream, STREAM_READAHEAD
+from ltorrent_async.server import StreamServer
+
+# seconds between two saves of the resume file
+RESUME_SAVE_INTERVAL = 30
+# longest wait for a request event, and seconds between two progress updates
+REQUEST_WAIT_TIMEOUT = 1
+PROGRESS_INTERVAL = 1
 
 
 class Client:
     last_percentage_completed = -1
     last_log_line = ""
 
-    def __init__(self, port, timeout=2, storage=None, stdout=None, sequential=False):
+    def __init__(self, port, timeout=2, storage=None, stdout=None, sequential=False, hash_workers=1, resume_dir=None, queue_depth=16, adaptive_queue_depth=False):
         self.port = port
         self.timeout = timeout
         if storage:
@@ -27,6 +35,10 @@ class Client:
         else:
             self.stdout = Logger()
         self.sequential = sequential
+        self.hash_workers = hash_workers
+        self.resume_dir = resume_dir
+        self.queue_depth = queue_depth
+        self.adaptive_queue_depth = adaptive_queue_depth
         self.is_active = True
 
         self.torrent = {}
@@ -35,8 +47,14 @@ class Client:
         self.peers_scraper = None
         self.pieces_manager = None
         self.peers_manager = None
+        self.resume = None
+        # periodic saves run in their own task, fsyncing the files can take a while
+        self.resume_task = None
 
         self.last_update = 0
+        self.last_resume_save = 0
+        self.last_progression = 0
+        self.is_waiting_unchoke = False
         self.retries = 0
 
     async def load(self, torrent_path='', magnet_link=''):
@@ -84,7 +102,15 @@ class Client:
 
     async def run(self):
         try:
-            self.init()
+            if not self.pieces_manager:
+                await self.init()
+
+            if self.pieces_manager.all_pieces_completed():
+                self._exit_threads()
+                self.pieces_manager.close()
+                await self.storage.close()
+                await self.stdout.INFO("File(s) already downloaded.")
+                return
 
             await self.peers_scraper.run()
             await self.peers_manager.run()
@@ -93,25 +119,41 @@ class Client:
 
             self.last_update = time.time()
 
-            if not self.sequential:
-                await self.send_piece_request()
-            else:
-                await self.send_piece_request_seq()
+            await self.send_piece_request()
 
             if self.is_active:
                 await self.display_progression()
                 self._exit_threads()
+                self.pieces_manager.close()
+                await self.storage.flush()
+                await self.save_resume()
+                await self.storage.close()
                 await self.stdout.INFO("File(s) downloaded successfully.")
+                await self.stdout.DEBUG("Hashed %.2fMB while downloading, %.2fMB on piece completion" % (
+                    self.pieces_manager.early_hashed_size / 1024 / 1024,
+                    self.pieces_manager.completion_hashed_size / 1024 / 1024
+                ))
+                await self.stdout.DEBUG("Endgame: %d duplicate requests, %d cancels" % (
+                    self.peers_manager.endgame_request_count,
+                    self.peers_manager.endgame_cancel_count
+                ))
             else:
                 self._exit_threads()
+                self.pieces_manager.close()
+                await self.save_resume()
+                await self.storage.close()
 
         except Exception as e:
             try:
                 self._exit_threads()
+                if self.pieces_manager:
+                    self.pieces_manager.close()
+                    await self.save_resume()
+                    await self.storage.close()
             finally:
                 await self.stdout.ERROR(e)
 
-    def init(self):
+    async def init(self):
         if not self.selection:
             raise Exception("You haven't select file(s).")
 
@@ -123,12 +165,35 @@ class Client:
             storage=self.storage,
             stdout=self.stdout,
             sequential=self.sequential,
+            hash_workers=self.hash_workers,
         )
+
+        if self.resume_dir:
+            self.resume = Resume(
+                resume_dir=self.resume_dir,
+                torrent=self.torrent,
+                storage=self.storage,
+                stdout=self.stdout,
+            )
+            restored_pieces = await self.resume.load(self.pieces_manager)
+            if restored_pieces:
+                await self.stdout.INFO("Resumed %d/%d pieces" % (restored_pieces, self.pieces_manager.number_of_active_pieces))
+
+        # after the resume data is checked, allocating changes the size and mtime of the files
+        for file_id in self.selection:
+            file = self.torrent.file_names[file_id]
+            if not await self.storage.exists(file['path']):
+                # a recheck won't read what allocate creates
+                self.pieces_manager.created_paths.add(file['path'])
+            await self.storage.allocate(file['path'], file['length'])
+
         self.peers_manager = PeersManager(
             torrent=self.torrent,
             pieces_manager=self.pieces_manager,
             peers_pool=self.peers_pool,
             stdout=self.stdout,
+            queue_depth=self.queue_depth,
+            adaptive_queue_depth=self.adaptive_queue_depth,
         )
         self.peers_scraper = PeersScraper(
             torrent=self.torrent,
@@ -146,77 +211,77 @@ class Client:
                 await self.stdout.INFO('Peers not enough')
 
     async def send_piece_request(self):
+        # in sequential mode the pieces manager requests the window of pieces at its write cursor and writes them in order
         while not self.pieces_manager.all_pieces_completed() and self.is_active:
-            for piece, block_index, block in self.pieces_manager.get_unfull_blocks():
-                if not self.is_active:
-                    break
-                
-                if not self.peers_manager.has_unchoked_peers():
-                    await self.stdout.INFO("No unchocked peers")
-                    await asyncio.sleep(1)
-                    continue
-                
-                piece.update_block_status()
+            await self.schedule_requests()
 
-                if block.state == State.FREE:
-                    block.state = State.PENDING
-                    block.last_seen = time.time()
+    async def schedule_requests(self):
+        # send what can be sent, then sleep until a peer may take requests or a request times out
+        request_event = self.pieces_manager.request_event
+        request_event.clear()
 
-                while True:
-                    if not self.is_active:
-                        break
-                    peer = self.peers_manager.get_random_peer_having_piece(index=piece.piece_index)
-                    await self.display_progression()
-                    if peer:
-                        break
-                    else:
-                        await asyncio.sleep(0.2)
-
-                piece_data = Request(
-                    piece_index=piece.piece_index,
-                    block_offset=block_index * BLOCK_SIZE,
-                    block_length=block.block_size
-                ).to_bytes()
-                await peer.send_to_peer(msg=piece_data)
-
-    async def send_piece_request_seq(self):
-        for group_index in range(self.pieces_manager.number_of_group):
-            if not self.is_active:
+        self.pieces_manager.update_block_status()
+
+        if not self.peers_manager.has_unchoked_peers():
+            if not self.is_waiting_unchoke:
+                await self.stdout.INFO("No unchocked peers")
+                self.is_waiting_unchoke = True
+        else:
+            self.is_waiting_unchoke = False
+            await self.request_blocks()
+            await self.peers_manager.flush_peers()
+
+        now = time.time()
+        if now - self.last_progression >= PROGRESS_INTERVAL:
+            self.last_progression = now
+            await self.display_progression()
+
+        timeout = REQUEST_WAIT_TIMEOUT
+        next_expiry = self.pieces_manager.get_next_expiry()
+        if next_expiry is not None:
+            timeout = min(timeout, max(next_expiry - now, 0))
+
+        try:
+            await asyncio.wait_for(request_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def request_blocks(self):
+        # walk the pieces in picking order, their free blocks going to the fastest ready peers having them
+        ranks = {peer.__hash__(): rank for rank, peer in enumerate(self.peers_manager.get_ready_peers())}
+        for piece_index in self.pieces_manager.get_request_pieces():
+            if not ranks:
                 break
-            while len(unfull_blocks := self.pieces_manager.get_group_unfull_blocks(group_index)) > 0:
-                if not self.is_active:
-                    break
-                for piece, block_index, block in unfull_blocks:
-                    if not self.is_active:
+
+            peers = [peer for peer in self.peers_manager.get_peers_having_piece(piece_index) if peer.__hash__() in ranks]
+            peers.sort(key=lambda peer: ranks[peer.__hash__()])
+            for peer in peers:
+                while peer.can_request():
+                    block = self.pieces_manager.get_piece_free_block(piece_index)
+                    if not block:
                         break
+                    await peer.request_block(*block)
+                else:
+                    # the request queue of the peer is full
+                    ranks.pop(peer.__hash__(), None)
+                    continue
 
-                    if not self.peers_manager.has_unchoked_peers():
-                        await self.stdout.INFO("No unchocked peers")
-                        await asyncio.sleep(1)
-                        continue
-
-                    piece.update_block_status()
-
-                    if block.state == State.FREE:
-                        block.state = State.PENDING
-                        block.last_seen = time.time()
-
-                    while True:
-                        if not self.is_active:
-                            break
-                        peer = self.peers_manager.get_random_peer_having_piece(index=piece.piece_index)
-                        await self.display_progression()
-                        if peer:
-                            break
-                        else:
-                            await asyncio.sleep(0.2)
-
-                    piece_data = Request(
-                        piece_index=piece.piece_index,
-                        block_offset=block_index * BLOCK_SIZE,
-                        block_length=block.block_size
-                    ).to_bytes()
-                    await peer.send_to_peer(msg=piece_data)
+                # no free block left in the piece
+                break
+
+        # a stream is waiting for these pieces, do not wait for a slow peer to send them
+        for start, end in self.pieces_manager.get_deadline_block_ranges():
+            if not self.pieces_manager.has_free_blocks(start, end):
+                await self.request_endgame_blocks(start, end)
+
+        start, end = self.pieces_manager.get_request_block_range()
+        if not self.pieces_manager.has_free_blocks(start, end):
+            await self.request_endgame_blocks(start, end)
+
+    async def request_endgame_blocks(self, start=0, end=None):
+        # every remaining block is in flight, ask more peers for them
+        for block in self.pieces_manager.get_pending_blocks(start, end):
+            await self.peers_manager.request_endgame_block(*block)
 
     async def restart(self):
         if self.retries > 3:
@@ -249,6 +314,71 @@ class Client:
         
         self.last_update = time.time()
 
+    async def recheck(self, workers=None):
+        # hash the selected data already in storage, e.g. copied from another machine
+        if not self.pieces_manager:
+            await self.init()
+
+        if not workers:
+            workers = os.cpu_count() or 1
+
+        start = time.time()
+        rechecked_size, restored_pieces = await self.pieces_manager.recheck(workers)
+        elapsed = max(time.time() - start, 0.001)
+
+        await self.stdout.INFO("Recheck: %d/%d pieces valid" % (restored_pieces, self.pieces_manager.number_of_active_pieces))
+        await self.stdout.DEBUG("Recheck: hashed %.2fMB in %.2fs, %.2fMB/s with %d workers" % (
+            rechecked_size / 1024 / 1024,
+            elapsed,
+            rechecked_size / 1024 / 1024 / elapsed,
+            workers
+        ))
+
+        await self.save_resume()
+
+        return restored_pieces
+
+    async def open_stream(self, file_id, readahead=STREAM_READAHEAD):
+        # file-like reader of a selected file, file_id being its index in torrent.file_names,
+        # readable while downloading
+        if not self.pieces_manager:
+            await self.init()
+        return FileStream(client=self, file_id=file_id, readahead=readahead)
+
+    async def serve(self, host='127.0.0.1', port=8000, readahead=STREAM_READAHEAD):
+        # local HTTP server answering Range requests on every selected file while downloading
+        if not self.pieces_manager:
+            await self.init()
+        server = StreamServer(client=self, host=host, port=port, readahead=readahead)
+        await server.start()
+        for file_id in self.selection:
+            await self.stdout.INFO("Streaming \"%s\" at %s" % (self.torrent.file_names[file_id]['path'], server.get_url(file_id)))
+        return server
+
+    def get_download_rates(self):
+        # "ip:port" -> download rate in bytes per second of every connected peer
+        if not self.peers_manager:
+            return {}
+        return self.peers_manager.get_download_rates()
+
+    async def save_resume(self):
+        if self.resume_task:
+            # a periodic save is still running
+            await self.resume_task
+        await self._save_resume()
+
+    async def _save_resume(self):
+        if self.resume:
+            await self.resume.save(self.pieces_manager)
+            self.last_resume_save = time.time()
+
+    def save_resume_in_background(self):
+        # blocks keep being requested while the files are fsynced
+        if self.resume_task and not self.resume_task.done():
+            return
+        self.last_resume_save = time.time()
+        self.resume_task = asyncio.create_task(self._save_resume())
+
     async def display_progression(self):
         now = time.time()
         if (now - self.last_update) > 300:
@@ -276,6 +406,9 @@ class Client:
             self.last_update = now
             self.last_percentage_completed = percentage_completed
 
+        if self.resume and (now - self.last_resume_save) > RESUME_SAVE_INTERVAL:
+            self.save_resume_in_background()
+
     def _exit_threads(self):
         self.peers_manager.is_active = False
         self.is_active = False
@@ -3,7 +3,7 @@ __author__ = 'alexisgallepe, L-ING'
 import random
 import socket
 import struct
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
 import bitstring
 
 HANDSHAKE_PSTR_V1 = b"BitTorrent protocol"
@@ -406,7 +406,7 @@ class Have(Message):
         self.piece_index = piece_index
 
     def to_bytes(self):
-        pack(">IBI", self.payload_length, self.message_id, self.piece_index)
+        return pack(">IBI", self.payload_length, self.message_id, self.piece_index)
 
     @classmethod
     def from_bytes(cls, payload):
@@ -548,11 +548,10 @@ class Piece(Message):
 
     @classmethod
     def from_bytes(cls, payload):
+        # block is a slice of payload, not a copy, it is only valid while payload is
         block_length = len(payload) - 13
-        _, message_id, piece_index, block_offset, block = unpack(
-            ">IBII{}s".format(block_length),
-            payload[:13 + block_length]
-        )
+        _, message_id, piece_index, block_offset = unpack_from(">IBII", payload)
+        block = payload[13:13 + block_length]
 
         if message_id != cls.message_id:
             raise WrongMessageException("Not a Piece message")
@@ -1,5 +1,6 @@
 __author__ = 'alexisgallepe, L-ING'
 
+import math
 import time
 import asyncio
 import struct
@@ -9,10 +10,27 @@ from ltorrent_async.message import (
     UnChoke,
     Interested,
     Handshake,
+    Request,
+    Cancel,
     KeepAlive,
     MessageDispatcher
 )
 from ltorrent_async.async_tcp import AsyncTCPClient
+from ltorrent_async.block import BLOCK_SIZE, PENDING_TIMEOUT
+
+# bounds of the adaptive request queue depth
+MIN_QUEUE_DEPTH = 2
+MAX_QUEUE_DEPTH = 256
+# seconds over which the download rate is measured
+RATE_WINDOW = 1
+# seconds of transfer kept requested on top of the round trip
+REQUEST_QUEUE_TIME = 1
+# bytes read from the socket at once, the read buffer is compacted when less is free at its end
+READ_SIZE = 65536
+# initial size of the read buffer
+READ_BUFFER_SIZE = 4 * READ_SIZE
+# unsent bytes above which no more requests or uploads are queued for a peer
+WRITE_BUFFER_LIMIT = 262144
 
 
 class Peer(object):
@@ -20,8 +38,13 @@ class Peer(object):
         self.last_call = 0.0
         self.has_handshaked = False
         self.healthy = False
-        self.read_buffer = b''
+        # received data is read_buffer[read_start:read_end], parsed in place and compacted only when full
+        self.read_buffer = bytearray(READ_BUFFER_SIZE)
+        self.read_start = 0
+        self.read_end = 0
         self.socket = None
+        # messages not sent yet, sent on flush
+        self.write_buffer = bytearray()
         self.ip = ip
         self.peers_manager = peers_manager
         self.pieces_manager = pieces_manager
@@ -35,7 +58,16 @@ class Peer(object):
             'peer_choking': True,
             'peer_interested': False,
         }
-        self.timeout_num = 0
+        # time data was last received from the peer
+        self.last_receive_time = time.time()
+        # (piece index, block offset) -> time the block was requested, not received yet
+        self.pending_requests = {}
+        self.queue_depth = peers_manager.queue_depth
+        self.adaptive_queue_depth = peers_manager.adaptive_queue_depth
+        self.min_rtt = 0.0
+        self.download_rate = 0.0
+        self.rate_window_start = time.time()
+        self.rate_window_size = 0
 
 
     def __hash__(self):
@@ -59,9 +91,23 @@ class Peer(object):
 
         return True
 
-    async def send_to_peer(self, msg):
+    async def send_to_peer(self, msg, flush=True):
+        # messages are queued in write_buffer, flush=False leaves them for the next PeersManager.flush_peers()
+        self.write_buffer += msg
+        if not flush:
+            self.peers_manager.add_unflushed_peer(self)
+            return
+        await self.flush()
+
+    async def flush(self):
+        # one write for everything queued, the transport sends it when the socket is writable
+        if not self.write_buffer:
+            return
+
+        data = bytes(self.write_buffer)
+        self.write_buffer.clear()
         try:
-            await self.socket.send(msg)
+            self.socket.write(data)
             self.last_call = time.time()
         except ConnectionResetError:
             self.healthy = False
@@ -76,9 +122,89 @@ class Peer(object):
             self.healthy = False
             await self.stdout.ERROR("Failed to send to peer:", e)
 
-    def is_eligible(self):
+    def is_write_blocked(self):
+        # backpressure, the peer does not read as fast as we write
+        return len(self.write_buffer) + self.socket.get_write_buffer_size() >= WRITE_BUFFER_LIMIT
+
+    async def request_block(self, piece_index, block_offset, block_length):
+        request = Request(
+            piece_index=piece_index,
+            block_offset=block_offset,
+            block_length=block_length
+        ).to_bytes()
+        await self.send_to_peer(msg=request, flush=False)
+
+        now = time.time()
+        if not self.pending_requests:
+            # the peer was idle, only measure the rate while blocks are requested
+            self.rate_window_start = now
+            self.rate_window_size = 0
+        self.pending_requests[(piece_index, block_offset)] = now
+
+    async def cancel_block(self, piece_index, block_offset, block_length):
+        cancel = Cancel(
+            piece_index=piece_index,
+            block_offset=block_offset,
+            block_length=block_length
+        ).to_bytes()
+        await self.send_to_peer(msg=cancel, flush=False)
+        self.pending_requests.pop((piece_index, block_offset), None)
+
+    def can_request(self):
+        if self.is_write_blocked():
+            return False
+
+        if len(self.pending_requests) < self.queue_depth:
+            return True
+
+        self.expire_requests()
+        return len(self.pending_requests) < self.queue_depth
+
+    def is_stalled(self):
+        # requests unanswered for longer than PENDING_TIMEOUT, and nothing received meanwhile
+        deadline = time.time() - PENDING_TIMEOUT
+        if self.last_receive_time >= deadline:
+            return False
+        return any(request_time < deadline for request_time in self.pending_requests.values())
+
+    def expire_requests(self):
+        # requests unanswered for too long are given up, their blocks are set free by the pieces manager
+        deadline = time.time() - PENDING_TIMEOUT
+        expired_keys = [key for key, request_time in list(self.pending_requests.items()) if request_time < deadline]
+        for key in expired_keys:
+            self.pending_requests.pop(key, None)
+        self.peers_manager.remove_endgame_requests(self, expired_keys)
+
+    def update_download_rate(self, block_length, request_time=None):
+        # moving average over RATE_WINDOW of the bytes received
         now = time.time()
-        return (now - self.last_call) > 0.2
+        if request_time:
+            rtt = now - request_time
+            if not self.min_rtt or rtt < self.min_rtt:
+                self.min_rtt = rtt
+
+        self.rate_window_size += block_length
+        if now - self.rate_window_start < RATE_WINDOW:
+            return
+
+        rate = self.rate_window_size / (now - self.rate_window_start)
+        self.download_rate = (self.download_rate + rate) / 2 if self.download_rate else rate
+        self.rate_window_start = now
+        self.rate_window_size = 0
+
+        if self.adaptive_queue_depth:
+            # bandwidth-delay product, the delay covering the round trip and the time to refill the queue
+            queue_size = self.download_rate * (self.min_rtt + REQUEST_QUEUE_TIME)
+            self.queue_depth = max(MIN_QUEUE_DEPTH, min(MAX_QUEUE_DEPTH, math.ceil(queue_size / BLOCK_SIZE)))
+
+    def get_download_rate(self):
+        # bytes per second, including the window being measured
+        elapsed = time.time() - self.rate_window_start
+        if elapsed < RATE_WINDOW:
+            return self.download_rate
+
+        rate = self.rate_window_size / elapsed
+        return (self.download_rate + rate) / 2 if self.download_rate else rate
 
     def has_piece(self, index):
         return self.bit_field[index]
@@ -104,10 +230,16 @@ class Peer(object):
     async def handle_choke(self):
         await self.stdout.DEBUG('handle_choke - %s' % self.ip)
         self.state['peer_choking'] = True
+        # a choking peer discards the requests it has not answered
+        self.peers_manager.remove_endgame_requests(self, list(self.pending_requests))
+        self.pending_requests.clear()
+        self.peers_manager.update_peer_index(self)
 
     async def handle_unchoke(self):
         await self.stdout.DEBUG('handle_unchoke - %s' % self.ip)
         self.state['peer_choking'] = False
+        self.peers_manager.update_peer_index(self)
+        self.peers_manager.notify_requests()
 
     async def handle_interested(self):
         await self.stdout.DEBUG('handle_interested - %s' % self.ip)
@@ -115,7 +247,7 @@ class Peer(object):
 
         if self.am_choking():
             unchoke = UnChoke().to_bytes()
-            await self.send_to_peer(msg=unchoke)
+            await self.send_to_peer(msg=unchoke, flush=False)
 
     async def handle_not_interested(self):
         await self.stdout.DEBUG('handle_not_interested - %s' % self.ip)
@@ -126,11 +258,15 @@ class Peer(object):
         :type have: message.Have
         """
         await self.stdout.DEBUG('handle_have - ip: %s - piece: %s' % (self.ip, have.piece_index))
-        self.bit_field[have.piece_index] = True
+        if not self.bit_field[have.piece_index]:
+            self.bit_field[have.piece_index] = True
+            self.pieces_manager.add_peer_piece(have.piece_index)
+            self.peers_manager.add_peer_index_piece(self, have.piece_index)
+            self.peers_manager.notify_requests()
 
         if self.is_choking() and not self.state['am_interested']:
             interested = Interested().to_bytes()
-            await self.send_to_peer(mgs=interested)
+            await self.send_to_peer(msg=interested, flush=False)
             self.state['am_interested'] = True
 
     async def handle_bitfield(self, bitfield):
@@ -138,11 +274,16 @@ class Peer(object):
         :type bitfield: message.BitField
         """
         await self.stdout.DEBUG('handle_bitfield - %s - %s' % (self.ip, bitfield.bitfield))
+        self.peers_manager.remove_peer_index(self)
+        self.pieces_manager.remove_peer_bitfield(self.bit_field)
         self.bit_field = bitfield.bitfield
+        self.pieces_manager.add_peer_bitfield(self.bit_field)
+        self.peers_manager.update_peer_index(self)
+        self.peers_manager.notify_requests()
 
         if self.is_choking() and not self.state['am_interested']:
             interested = Interested().to_bytes()
-            await self.send_to_peer(msg=interested)
+            await self.send_to_peer(msg=interested, flush=False)
             self.state['am_interested'] = True
 
     async def handle_request(self, request):
@@ -158,18 +299,20 @@ class Peer(object):
         :type message: message.Piece
         """
         # await self.stdout.DEBUG('handle_piece - %s' % self.ip)
-        if self.pieces_manager.sequential:
-            await self.pieces_manager.receive_block_piece_seq(
-                piece_index=message.piece_index,
-                piece_offset=message.block_offset,
-                piece_data=message.block
-            )
-        else:
-            await self.pieces_manager.receive_block_piece(
-                piece_index=message.piece_index,
-                piece_offset=message.block_offset,
-                piece_data=message.block
-            )
+        await self.pieces_manager.receive_block_piece(
+            piece_index=message.piece_index,
+            piece_offset=message.block_offset,
+            piece_data=message.block
+        )
+        request_time = self.pending_requests.pop((message.piece_index, message.block_offset), None)
+        self.update_download_rate(len(message.block), request_time)
+        await self.peers_manager.cancel_endgame_requests(
+            piece_index=message.piece_index,
+            block_offset=message.block_offset,
+            block_length=message.block_length,
+            peer=self
+        )
+        self.peers_manager.notify_requests()
 
     async def handle_cancel(self):
         await self.stdout.DEBUG('handle_cancel - %s' % self.ip)
@@ -177,11 +320,38 @@ class Peer(object):
     async def handle_port_request(self):
         await self.stdout.DEBUG('handle_port_request - %s' % self.ip)
 
-    async def _handle_handshake(self):
+    def _compact_read_buffer(self):
+        # move the unparsed data to the front, into a larger buffer if it still lacks room for a read
+        size = self.read_end - self.read_start
+        if len(self.read_buffer) - size < READ_SIZE:
+            # a new buffer rather than a resize, a received block may still be viewing the old one
+            read_buffer = bytearray(len(self.read_buffer) + max(READ_SIZE, len(self.read_buffer)))
+            read_buffer[:size] = self.read_buffer[self.read_start:self.read_end]
+            self.read_buffer = read_buffer
+        elif self.read_start:
+            self.read_buffer[:size] = self.read_buffer[self.read_start:self.read_end]
+        self.read_start = 0
+        self.read_end = size
+
+    async def read_from_socket(self):
+        # read once into the free end of the read buffer, returns the number of bytes read
+        data = await self.socket.recv(READ_SIZE)
+        if not data:
+            self.healthy = False
+            return 0
+
+        self.last_receive_time = time.time()
+        if len(self.read_buffer) - self.read_end < len(data):
+            self._compact_read_buffer()
+        self.read_buffer[self.read_end:self.read_end + len(data)] = data
+        self.read_end += len(data)
+        return len(data)
+
+    async def _handle_handshake(self, buffer):
         try:
-            handshake_message = Handshake.from_bytes(payload=self.read_buffer)
+            handshake_message = Handshake.from_bytes(payload=buffer[self.read_start:self.read_end])
             self.has_handshaked = True
-            self.read_buffer = self.read_buffer[handshake_message.total_length:]
+            self.read_start += handshake_message.total_length
             await self.stdout.DEBUG('handle_handshake - %s' % self.ip)
             return True
 
@@ -191,37 +361,41 @@ class Peer(object):
 
         return False
 
-    async def _handle_keep_alive(self):
+    async def _handle_keep_alive(self, buffer):
         try:
-            keep_alive = KeepAlive.from_bytes(payload=self.read_buffer)
+            keep_alive = KeepAlive.from_bytes(payload=buffer[self.read_start:self.read_end])
             await self.stdout.DEBUG('handle_keep_alive - %s' % self.ip)
         except WrongMessageException:
             # try to handle keep alive message in every loop
             return False
         except Exception as e:
-            await self.stdout.ERROR("Error KeepALive, need at least 4 bytes, but got %d bytes:" % len(self.read_buffer), e)
+            await self.stdout.ERROR("Error KeepALive, need at least 4 bytes, but got %d bytes:" % (self.read_end - self.read_start), e)
             return False
 
-        self.read_buffer = self.read_buffer[keep_alive.total_length:]
+        self.read_start += keep_alive.total_length
         return True
 
     async def get_messages(self):
-        while len(self.read_buffer) > 4 and self.healthy:
-            if (not self.has_handshaked and await self._handle_handshake()) or await self._handle_keep_alive():
-                continue
-
-            payload_length, = struct.unpack(">I", self.read_buffer[:4])
-            total_length = payload_length + 4
-
-            if len(self.read_buffer) < total_length:
-                break
-            else:
-                payload = self.read_buffer[:total_length]
-                self.read_buffer = self.read_buffer[total_length:]
-
-            try:
-                received_message = await MessageDispatcher(payload=payload, stdout=self.stdout).dispatch()
-                if received_message:
-                    yield received_message
-            except WrongMessageException as e:
-                await self.stdout.ERROR("Wrong message received in peer.Peer.get_messages:", e)
+        with memoryview(self.read_buffer) as buffer:
+            while self.read_end - self.read_start > 4 and self.healthy:
+                if (not self.has_handshaked and await self._handle_handshake(buffer)) or await self._handle_keep_alive(buffer):
+                    continue
+
+                payload_length, = struct.unpack_from(">I", buffer, self.read_start)
+                total_length = payload_length + 4
+
+                if self.read_end - self.read_start < total_length:
+                    break
+                else:
+                    payload = buffer[self.read_start:self.read_start + total_length]
+                    self.read_start += total_length
+
+                try:
+                    received_message = await MessageDispatcher(payload=payload, stdout=self.stdout).dispatch()
+                    if received_message:
+                        yield received_message
+                except WrongMessageException as e:
+                    await self.stdout.ERROR("Wrong message received in peer.Peer.get_messages:", e)
+
+        if self.read_start == self.read_end:
+            self.read_start = self.read_end = 0
@@ -36,6 +36,8 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 MAX_WORKERS = 10
 SEMA = asyncio.Semaphore(MAX_WORKERS)
+# peers asked for the same block in endgame mode
+ENDGAME_MAX_PEERS = 3
 
 class SockAddr:
     def __init__(self, ip, port, allowed=True):
@@ -51,6 +53,12 @@ class PeersPool:
     dict_sock_addr = {}
     connected_peers = {}
 
+    def add_peer(self, peer):
+        self.connected_peers[peer.__hash__()] = peer
+
+    def remove_peer(self, peer_hash):
+        return self.connected_peers.pop(peer_hash, None)
+
     
 class HTTPScraper:
     def __init__(self, torrent, tracker, peers_pool, stdout, port=6881, timeout=2):
@@ -299,7 +307,7 @@ class PeersConnector:
                 if not await new_peer.connect(timeout=self.timeout) or not await self.do_handshake(new_peer):
                     self.del_queue.put(new_peer.__hash__())
                 else:
-                    self.peers_pool.connected_peers[new_peer.__hash__()] = new_peer
+                    self.peers_manager.add_peer(new_peer)
                     await self.stdout.DEBUG("new peer added: ip: %s - port: %s" % (new_peer.ip, new_peer.port))
             except Exception as e:
                 await self.stdout.ERROR("Error in peers connector:", e)
@@ -379,8 +387,8 @@ class PeersScraper:
         
         for del_peer in self.queue.queue:
             try:
+                self.peers_pool.remove_peer(del_peer)
                 del self.peers_pool.dict_sock_addr[del_peer]
-                del self.peers_pool.connected_peers[del_peer]
             except:
                 continue
         
@@ -388,11 +396,24 @@ class PeersScraper:
 
 
 class PeersManager:
-    def __init__(self, torrent, pieces_manager, peers_pool, stdout):
+    def __init__(self, torrent, pieces_manager, peers_pool, stdout, queue_depth=16, adaptive_queue_depth=False):
         self.torrent = torrent
         self.pieces_manager = pieces_manager
         self.peers_pool = peers_pool
-        self.pieces_by_peer = [[0, []] for _ in range(pieces_manager.number_of_pieces)]
+        # outstanding block requests per peer
+        self.queue_depth = queue_depth
+        self.adaptive_queue_depth = adaptive_queue_depth
+        # (piece index, block offset) -> peers asked for the block in endgame mode
+        self.endgame_requests = {}
+        self.endgame_request_count = 0
+        self.endgame_cancel_count = 0
+        # piece index -> {"ip:port": peer} of the unchoked peers having the piece that we are interested in
+        self.peers_by_piece = [{} for _ in range(int(torrent.number_of_pieces))]
+        self.indexed_peers = {}
+        # "ip:port" -> peer having messages queued since the last flush
+        self.unflushed_peers = {}
+        # "ip:port" -> (peer, task reading from the peer until it is removed)
+        self.reader_tasks = {}
         self.is_active = True
         self.stdout = stdout
 
@@ -402,6 +423,11 @@ class PeersManager:
 
         piece_index, block_offset, block_length = request.piece_index, request.block_offset, request.block_length
 
+        if peer.is_write_blocked():
+            # the peer will ask again, queuing more would only grow its send queue
+            await self.stdout.DEBUG("Send queue full, dropped request of piece index {} from peer : {}".format(piece_index, peer.ip))
+            return
+
         block = await self.pieces_manager.get_block(
             piece_index=piece_index,
             block_offset=block_offset,
@@ -414,15 +440,135 @@ class PeersManager:
                 block_offset=block_offset,
                 block=block
             ).to_bytes()
-            await peer.send_to_peer(mgs=piece)
+            await peer.send_to_peer(msg=piece)
             await self.stdout.DEBUG("Sent piece index {} to peer : {}".format(request.piece_index, peer.ip))
 
-    def get_random_peer_having_piece(self, index):
+    def get_ready_peers(self):
+        # peers able to take more requests, fastest first, peers without a measured rate in random order
         ready_peers = []
-        for peer in self.peers_pool.connected_peers.values():
-            if peer.is_eligible() and peer.is_unchoked() and peer.am_interested() and peer.has_piece(index):
-                ready_peers.append(peer)
-        return random.choice(ready_peers) if ready_peers else None
+        for peer in list(self.indexed_peers.values()):
+            if peer.can_request():
+                ready_peers.append((peer.get_download_rate(), random.random(), peer))
+        ready_peers.sort(key=lambda item: item[:2], reverse=True)
+        return [peer for _, _, peer in ready_peers]
+
+    def get_download_rates(self):
+        # "ip:port" -> download rate in bytes per second of every connected peer
+        return {
+            peer_hash: peer.get_download_rate()
+            for peer_hash, peer in list(self.peers_pool.connected_peers.items())
+        }
+
+    def notify_requests(self):
+        self.pieces_manager.notify_requests()
+
+    def add_unflushed_peer(self, peer):
+        self.unflushed_peers[peer.__hash__()] = peer
+
+    async def flush_peers(self):
+        # one send per peer for the messages queued since the last flush
+        while self.unflushed_peers:
+            try:
+                _, peer = self.unflushed_peers.popitem()
+            except KeyError:
+                break
+            await peer.flush()
+
+    def add_peer(self, peer):
+        self.peers_pool.add_peer(peer)
+        if self.is_active:
+            self.register_peer(peer)
+        self.notify_requests()
+
+    def register_peer(self, peer):
+        peer_hash = peer.__hash__()
+        reader = self.reader_tasks.get(peer_hash)
+        if reader and reader[0] is peer and not reader[1].done():
+            return
+        self.reader_tasks[peer_hash] = (peer, asyncio.create_task(self.read_from_peer(peer)))
+
+    def unregister_peer(self, peer):
+        reader = self.reader_tasks.get(peer.__hash__())
+        if not reader or reader[0] is not peer:
+            return
+        del self.reader_tasks[peer.__hash__()]
+        if reader[1] is not asyncio.current_task():
+            reader[1].cancel()
+
+    async def read_from_peer(self, peer):
+        while self.is_active and self.peers_pool.connected_peers.get(peer.__hash__()) is peer:
+            await self.listen_to_peer(peer)
+
+    def update_peer_index(self, peer):
+        # keep peers_by_piece in line with the choke and interest state of peer
+        peer_hash = peer.__hash__()
+        is_ready = peer.is_unchoked() and peer.am_interested() and peer_hash in self.peers_pool.connected_peers
+        if is_ready and peer_hash not in self.indexed_peers:
+            self.indexed_peers[peer_hash] = peer
+            for piece_index in peer.bit_field.findall('0b1'):
+                if piece_index < len(self.peers_by_piece):
+                    self.peers_by_piece[piece_index][peer_hash] = peer
+        elif not is_ready and peer_hash in self.indexed_peers:
+            self.remove_peer_index(peer)
+
+    def remove_peer_index(self, peer):
+        peer_hash = peer.__hash__()
+        if self.indexed_peers.pop(peer_hash, None) is None:
+            return
+
+        for piece_index in peer.bit_field.findall('0b1'):
+            if piece_index < len(self.peers_by_piece):
+                self.peers_by_piece[piece_index].pop(peer_hash, None)
+
+    def add_peer_index_piece(self, peer, piece_index):
+        peer_hash = peer.__hash__()
+        if peer_hash in self.indexed_peers and piece_index < len(self.peers_by_piece):
+            self.peers_by_piece[piece_index][peer_hash] = peer
+
+    def get_peers_having_piece(self, piece_index):
+        # unchoked peers having the piece, without scanning the connected peers
+        return list(self.peers_by_piece[piece_index].values())
+
+    async def request_endgame_block(self, piece_index, block_offset, block_length):
+        # ask more peers for a block already in flight
+        key = (piece_index, block_offset)
+        requesters = self.endgame_requests.get(key)
+        if requesters is None:
+            requesters = [peer for peer in self.get_peers_having_piece(piece_index) if key in peer.pending_requests]
+            self.endgame_requests[key] = requesters
+
+        if len(requesters) >= ENDGAME_MAX_PEERS:
+            return
+
+        candidates = [
+            peer for peer in self.get_peers_having_piece(piece_index)
+            if peer not in requesters and key not in peer.pending_requests and peer.can_request()
+        ]
+        candidates.sort(key=lambda peer: peer.get_download_rate(), reverse=True)
+        for peer in candidates[:ENDGAME_MAX_PEERS - len(requesters)]:
+            await peer.request_block(piece_index, block_offset, block_length)
+            requesters.append(peer)
+            self.endgame_request_count += 1
+
+    def remove_endgame_requests(self, peer, keys):
+        # peer won't answer these requests, other peers can be asked for the blocks
+        for key in keys:
+            requesters = self.endgame_requests.get(key)
+            if requesters and peer in requesters:
+                requesters.remove(peer)
+                if not requesters:
+                    self.endgame_requests.pop(key, None)
+
+    async def cancel_endgame_requests(self, piece_index, block_offset, block_length, peer):
+        # the block arrived from peer, cancel it on the others
+        requesters = self.endgame_requests.pop((piece_index, block_offset), None)
+        if not requesters:
+            return
+
+        for other_peer in requesters:
+            if other_peer is not peer and (piece_index, block_offset) in other_peer.pending_requests:
+                await other_peer.cancel_block(piece_index, block_offset, block_length)
+                self.endgame_cancel_count += 1
 
     def has_unchoked_peers(self):
         for peer in self.peers_pool.connected_peers.values():
@@ -437,79 +583,66 @@ class PeersManager:
                 cpt += 1
         return cpt
 
-    async def _read_from_socket(self, sock):
-        buff = await sock.recv(4096)
-        return buff
-
-    async def listen_to_peer(self, peer, SEMA):
-        async with SEMA:
+    async def listen_to_peer(self, peer):
+        try:
+            if not peer.healthy:
+                await self.remove_peer(peer=peer)
+                return
+            
             try:
-                if not peer.healthy:
-                    await self.remove_peer(peer=peer)
-                    return
-                
-                try:
-                    payload = await self._read_from_socket(peer.socket)
-                    peer.timeout_num = 0
-                except asyncio.TimeoutError:
-                    peer.timeout_num += 1
-                    if peer.timeout_num > 5:
-                        await self.stdout.WARNING("Peer too many timeout, removed")
-                        await self.remove_peer(peer=peer)
-                    return
-                except BlockingIOError:
-                    # Resource temporarily unavailable
-                    # await self.stdout.WARNING('Blocking IO in PeersManager:', e)
-                    return
-                except ConnectionResetError:
-                    await self.stdout.WARNING("Connection reset by peer in PeersManager")
-                    await self.remove_peer(peer=peer)
-                    return
-                except OSError:
-                    await self.stdout.WARNING("Socket closed in PeersManager")
-                    await self.remove_peer(peer=peer)
-                    return
-                except Exception as e:
-                    await self.stdout.ERROR("Error when read from socket in peers_manager.PeersManager:", e)
+                await peer.read_from_socket()
+            except asyncio.TimeoutError:
+                # an idle peer is kept, as by the selector loop, unless it leaves our requests unanswered
+                if peer.is_stalled():
+                    await self.stdout.WARNING("Peer not answering requests, removed")
                     await self.remove_peer(peer=peer)
-                    return
-
-                peer.read_buffer += payload
-                async for message in peer.get_messages():
-                    await self._process_new_message(new_message=message, peer=peer)
-
+                return
+            except BlockingIOError:
+                # Resource temporarily unavailable
+                # await self.stdout.WARNING('Blocking IO in PeersManager:', e)
+                return
+            except ConnectionResetError:
+                await self.stdout.WARNING("Connection reset by peer in PeersManager")
+                await self.remove_peer(peer=peer)
+                return
+            except OSError:
+                await self.stdout.WARNING("Socket closed in PeersManager")
+                await self.remove_peer(peer=peer)
+                return
             except Exception as e:
-                await self.stdout.ERROR("Error when listen to peer", e)
+                await self.stdout.ERROR("Error when read from socket in peers_manager.PeersManager:", e)
                 await self.remove_peer(peer=peer)
+                return
+
+            async for message in peer.get_messages():
+                await self._process_new_message(new_message=message, peer=peer)
+            await self.flush_peers()
+
+        except Exception as e:
+            await self.stdout.ERROR("Error when listen to peer", e)
+            await self.remove_peer(peer=peer)
 
     async def start(self):
-        SEMA = asyncio.Semaphore(1)
-        while self.is_active:
-            try:
-                task_list = [self.listen_to_peer(peer, SEMA) for peer in self.peers_pool.connected_peers.values()]
-                await asyncio.gather(*task_list)
-            except Exception as e:
-                await self.stdout.ERROR("Error when looping peers manager:", e)
-                break
-    
+        for peer in list(self.peers_pool.connected_peers.values()):
+            self.register_peer(peer)
+
     async def run(self):
         self.is_active = True
-        asyncio.create_task(self.start())
+        await self.start()
 
     async def remove_peer(self, peer):
-        if peer in self.peers_pool.connected_peers.values():
+        if self.peers_pool.connected_peers.get(peer.__hash__()) is peer:
+            self.unregister_peer(peer)
             try:
                 await peer.socket.close()
             except Exception as e:
                 await self.stdout.ERROR("Wrong when remove peer: %s" % e)
 
-            del self.peers_pool.connected_peers[peer.__hash__()]
-
-    def get_peer_by_socket(self, socket):
-        for peer in self.peers_pool.connected_peers.values():
-            if socket == peer.socket:
-                return peer
-        raise Exception("Peer not present in peer_list")
+            self.peers_pool.remove_peer(peer.__hash__())
+            self.remove_peer_index(peer)
+            self.remove_endgame_requests(peer, list(peer.pending_requests))
+            self.pieces_manager.remove_peer_bitfield(peer.bit_field)
+            self.notify_requests()
 
     async def _process_new_message(self, new_message: Message, peer: Peer):
         if isinstance(new_message, Handshake) or isinstance(new_message, KeepAlive):
@@ -2,8 +2,7 @@ __author__ = 'alexisgallepe, L-ING'
 
 import hashlib
 import math
-import time
-from ltorrent_async.block import Block, BLOCK_SIZE, State
+from ltorrent_async.block import BLOCK_SIZE, State
 
 
 class Piece(object):
@@ -13,92 +12,116 @@ class Piece(object):
         self.piece_hash: str = piece_hash
         self.pieces_manager = pieces_manager
         self.is_full: bool = False
-        self.files = []
         self.number_of_blocks: int = math.ceil(piece_size / BLOCK_SIZE)
-        self.blocks: list[Block] = []
+        # piece data, allocated when the first block is received
+        self.buffer: bytearray = None
+        self.view: memoryview = None
+        # sha1 of the leading full blocks, fed as they arrive
+        self.hasher = None
+        self.hashed_size: int = 0
+        self.is_hashing: bool = False
         self.storage = storage
-        self.is_active = 0
+        self.is_active: bool = False
         self.stdout = stdout
 
-        self._init_blocks()
+    def set_block(self, offset, data):
+        # offset comes from the peer, a block must start on a block boundary inside the piece
+        if offset % BLOCK_SIZE or offset >= self.piece_size:
+            return False
 
-    def update_block_status(self):  # if block is pending for too long : set it free
-        for i, block in enumerate(self.blocks):
-            if block.state == State.PENDING and (time.time() - block.last_seen) > 5:
-                self.blocks[i] = Block()
+        block_table = self.pieces_manager.block_table
+        block_index = block_table.get_block_index(self.piece_index, offset)
+        block_size = block_table.get_block_size(block_index)
 
-    def set_block(self, offset, data):
-        index = offset // BLOCK_SIZE
+        if len(data) != block_size or self.is_full or block_table.get_state(block_index) == State.FULL:
+            return False
+
+        if self.buffer is None:
+            self.buffer = bytearray(self.piece_size)
+            self.view = memoryview(self.buffer)
+        self.view[offset:offset + block_size] = data
+        block_table.set_full(block_index)
+        self.pieces_manager.completed_size += block_size
 
-        if not self.is_full and not self.blocks[index].state == State.FULL:
-            self.blocks[index].data = data
-            self.blocks[index].state = State.FULL
-            self.pieces_manager.completed_size += self.blocks[index].block_size
+        return True
 
     async def get_block(self, block_offset, block_length):
-        return await self.storage.read(self.files, block_offset, block_length)
+        return await self.storage.read(
+            self.pieces_manager.get_piece_spans(self.piece_index, block_offset, block_length),
+            block_length
+        )
 
     def get_empty_block(self):
         if self.is_full:
             return None
 
-        for block_index, block in enumerate(self.blocks):
-            if block.state == State.FREE:
-                self.blocks[block_index].state = State.PENDING
-                self.blocks[block_index].last_seen = time.time()
-                return self.piece_index, block_index * BLOCK_SIZE, block.block_size
+        block_table = self.pieces_manager.block_table
+        block_index = block_table.next_free(*block_table.get_piece_range(self.piece_index))
+        if block_index is None:
+            return None
 
-        return None
+        block_table.set_pending(block_index)
+        return block_table.get_block_info(block_index)
 
     def are_all_blocks_full(self):
-        for block in self.blocks:
-            if block.state == State.FREE or block.state == State.PENDING:
-                return False
-
-        return True
+        return self.pieces_manager.block_table.is_piece_full(self.piece_index)
 
     async def set_to_full(self):
-        data = self._merge_blocks()
-
-        if not await self._valid_blocks(piece_raw_data=data):
-            self._init_blocks()
-            return False
-
+        # the piece has already been verified by the pieces manager
         self.is_full = True
-        await self.storage.write(self.files, data)
+        await self.storage.write(self.pieces_manager.get_piece_spans(self.piece_index), self.view)
         self.clear()
         self.pieces_manager.update_bitfield(self.piece_index)
 
-        return True
-
     def _init_blocks(self):
-        self.blocks = []
+        self.pieces_manager.block_table.reset_piece(self.piece_index)
+        self.clear()
+
+    def clear(self):
+        if self.view is not None:
+            self.view.release()
+        self.buffer = None
+        self.view = None
+        self.hasher = None
+        self.hashed_size = 0
+
+    def can_update_hash(self):
+        if self.hashed_size >= self.piece_size:
+            return False
 
-        if self.number_of_blocks > 1:
-            for _ in range(self.number_of_blocks):
-                self.blocks.append(Block())
+        block_table = self.pieces_manager.block_table
+        block_index = block_table.get_block_index(self.piece_index, self.hashed_size)
+        return block_table.states[block_index] == State.FULL.value
 
-            # Last block of last piece, the special block
-            if (self.piece_size % BLOCK_SIZE) > 0:
-                self.blocks[self.number_of_blocks - 1].block_size = self.piece_size % BLOCK_SIZE
+    def is_hashed(self):
+        return self.hashed_size == self.piece_size
 
-        else:
-            self.blocks.append(Block(block_size=int(self.piece_size)))
+    def update_hash(self):
+        # feed the hasher with the full blocks following the hashed ones
+        block_table = self.pieces_manager.block_table
+        block_index = block_table.get_block_index(self.piece_index, self.hashed_size)
+        end = self.hashed_size
 
-    def clear(self):
-        for block in self.blocks:
-            block.data = b''
+        while end < self.piece_size and block_table.states[block_index] == State.FULL.value:
+            end = min(end + BLOCK_SIZE, self.piece_size)
+            block_index += 1
 
-    def _merge_blocks(self):
-        buf = b''
+        if end == self.hashed_size:
+            return 0
 
-        for block in self.blocks:
-            buf += block.data
+        if self.hasher is None:
+            self.hasher = hashlib.sha1()
+        self.hasher.update(self.view[self.hashed_size:end])
 
-        return buf
+        hashed_size = end - self.hashed_size
+        self.hashed_size = end
+        return hashed_size
+
+    async def _valid_blocks(self):
+        if not self.is_hashed():
+            return False
 
-    async def _valid_blocks(self, piece_raw_data):
-        hashed_piece_raw_data = hashlib.sha1(piece_raw_data).digest()
+        hashed_piece_raw_data = self.hasher.digest()
 
         if hashed_piece_raw_data == self.piece_hash:
             return True
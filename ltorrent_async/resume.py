@@ -0,0 +1,104 @@
+__author__ = 'L-ING'
+
+import os
+import json
+import bitstring
+
+
+class Resume(object):
+    """
+    Resume file = <resume_dir>/<info_hash as hex>.resume
+
+    {
+        "info_hash": info hash as hex,
+        "pieces": bitfield of the pieces written to storage, as hex,
+        "files": [{"path": path, "length": size on disk, "mtime": mtime in ns}, ...]
+    }
+
+    A completed piece is restored as is if every selected file it covers
+    still has the recorded size and mtime, otherwise it is hashed again:
+    pieces written after the last save change the mtime of their files.
+    """
+
+    def __init__(self, resume_dir, torrent, storage, stdout):
+        self.resume_dir = resume_dir
+        self.torrent = torrent
+        self.storage = storage
+        self.stdout = stdout
+        self.path = os.path.join(resume_dir, torrent.info_hash.hex() + '.resume')
+
+    async def load(self, pieces_manager):
+        if not os.path.exists(self.path):
+            return 0
+
+        try:
+            with open(self.path, 'r') as file:
+                resume_data = json.load(file)
+
+            if resume_data['info_hash'] != self.torrent.info_hash.hex():
+                await self.stdout.WARNING("Resume file doesn't match torrent:", self.path)
+                return 0
+
+            bitfield = bitstring.BitArray(bytes=bytes.fromhex(resume_data['pieces']))
+        except Exception as e:
+            await self.stdout.ERROR("Failed to load resume file %s:" % self.path, e)
+            return 0
+
+        unchanged_files = set()
+        for file in resume_data['files']:
+            if await self.storage.stat(file['path']) == (file['length'], file['mtime']):
+                unchanged_files.add(file['path'])
+
+        piece_index_list = []
+        changed_piece_index_list = []
+        for piece in pieces_manager.pieces:
+            if piece.piece_index >= len(bitfield) or not bitfield[piece.piece_index]:
+                continue
+            if not piece.is_active:
+                continue
+            if all(span.path in unchanged_files for span in pieces_manager.get_piece_spans(piece.piece_index)):
+                piece_index_list.append(piece.piece_index)
+            else:
+                changed_piece_index_list.append(piece.piece_index)
+
+        restored_pieces = pieces_manager.restore_pieces(piece_index_list)
+
+        if changed_piece_index_list:
+            rechecked_size, rechecked_pieces = await pieces_manager.recheck(os.cpu_count() or 1, changed_piece_index_list)
+            await self.stdout.DEBUG("Resume: %d/%d pieces of changed files still valid" % (rechecked_pieces, len(changed_piece_index_list)))
+            restored_pieces += rechecked_pieces
+
+        return restored_pieces
+
+    async def save(self, pieces_manager):
+        # bitfield first, pieces written after it only make the files look changed
+        pieces = pieces_manager.bitfield.tobytes().hex()
+        # then the pieces it records are made durable, a resume file can't record pieces which may be lost
+        try:
+            await self.storage.flush()
+        except OSError as e:
+            await self.stdout.ERROR("Failed to flush storage, resume file %s not saved:" % self.path, e)
+            return
+
+        files = []
+        for file_id in pieces_manager.selection:
+            path = self.torrent.file_names[file_id]['path']
+            file_stat = await self.storage.stat(path)
+            if file_stat:
+                files.append({"path": path, "length": file_stat[0], "mtime": file_stat[1]})
+
+        resume_data = {
+            "info_hash": self.torrent.info_hash.hex(),
+            "pieces": pieces,
+            "files": files
+        }
+
+        try:
+            if not os.path.exists(self.resume_dir):
+                os.makedirs(self.resume_dir)
+
+            with open(self.path + '.tmp', 'w') as file:
+                json.dump(resume_data, file)
+            os.replace(self.path + '.tmp', self.path)
+        except Exception as e:
+            await self.stdout.ERROR("Failed to save resume file %s:" % self.path, e)
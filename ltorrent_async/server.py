@@ -0,0 +1,166 @@
+__author__ = 'L-ING'
+
+import os
+import re
+import asyncio
+import mimetypes
+from http import HTTPStatus
+from urllib.parse import quote, unquote
+from ltorrent_async.stream import FileStream, STREAM_READAHEAD
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+# longest request line and headers accepted
+MAX_REQUEST_SIZE = 65536
+
+
+def parse_range(header, length):
+    # (start, end) inclusive of a single "bytes=" range, None for the whole file, ValueError if unsatisfiable
+    if not header:
+        return None
+
+    match = RANGE_PATTERN.match(header.strip())
+    if not match:
+        # multiple ranges or another unit, answer with the whole file
+        return None
+
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # suffix range, the last bytes of the file
+        suffix = int(last)
+        if suffix == 0 or length == 0:
+            raise ValueError("Unsatisfiable range %s" % header)
+        return max(length - suffix, 0), length - 1
+
+    start = int(first)
+    end = int(last) if last else length - 1
+    if start >= length or end < start:
+        raise ValueError("Unsatisfiable range %s" % header)
+    return start, min(end, length - 1)
+
+
+class StreamServer(object):
+    """
+    Local HTTP server exposing every selected file of a client, usable while the torrent downloads:
+
+    - each request reads through a FileStream, so the requested range gets priority over the rest of the torrent
+    - the response is sent piece by piece as soon as each one is verified and written
+    - one request per connection, files are served at /<file_id>/<file name>
+    """
+
+    def __init__(self, client, host='127.0.0.1', port=8000, readahead=STREAM_READAHEAD):
+        self.client = client
+        self.host = host
+        self.port = port
+        self.readahead = readahead
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port, limit=MAX_REQUEST_SIZE)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def get_url(self, file_id):
+        path = self.client.torrent.file_names[file_id]['path']
+        return 'http://%s:%d/%d/%s' % (self.host, self.port, file_id, quote(os.path.basename(path)))
+
+    def get_file_id(self, request_path):
+        # /<file_id>/<file name>, the name being only for players guessing the type from the url
+        parts = unquote(request_path.split('?')[0]).strip('/').split('/')
+        if not parts[0].isdigit():
+            return None
+
+        file_id = int(parts[0])
+        file_table = self.client.pieces_manager.file_table
+        if file_id >= file_table.number_of_files or not file_table.selected[file_id]:
+            return None
+        return file_id
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            lines = request.decode('latin-1').split('\r\n')
+            method, path = lines[0].split(' ')[:2]
+            headers = {}
+            for line in lines[1:]:
+                if ':' in line:
+                    name, value = line.split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+
+            if method not in ('GET', 'HEAD'):
+                await self.send_response(writer, HTTPStatus.NOT_IMPLEMENTED)
+            else:
+                await self.handle_stream(writer, path, headers.get('range'), send_body=(method == 'GET'))
+            await self.client.stdout.DEBUG("HTTP %s - \"%s\"" % (writer.get_extra_info('peername'), lines[0]))
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            # not an http request
+            pass
+        except (BrokenPipeError, ConnectionResetError):
+            # the player closed the connection, e.g. to seek
+            pass
+        finally:
+            writer.close()
+
+    async def send_response(self, writer, status, headers=None):
+        response = 'HTTP/1.1 %d %s\r\n' % (status, status.phrase)
+        for name, value in (headers or {}).items():
+            response += '%s: %s\r\n' % (name, value)
+        if not headers:
+            response += 'Content-Length: 0\r\n'
+        response += 'Connection: close\r\n\r\n'
+        writer.write(response.encode('latin-1'))
+        await writer.drain()
+
+    async def handle_stream(self, writer, path, range_header, send_body):
+        file_id = self.get_file_id(path)
+        if file_id is None:
+            await self.send_response(writer, HTTPStatus.NOT_FOUND)
+            return
+
+        stream = FileStream(client=self.client, file_id=file_id, readahead=self.readahead)
+        try:
+            try:
+                data_range = parse_range(range_header, stream.length)
+            except ValueError:
+                await self.send_response(writer, HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, {
+                    'Content-Range': 'bytes */%d' % stream.length,
+                    'Content-Length': '0'
+                })
+                return
+
+            headers = {}
+            if data_range is None:
+                start, end = 0, stream.length - 1
+                status = HTTPStatus.OK
+            else:
+                start, end = data_range
+                status = HTTPStatus.PARTIAL_CONTENT
+                headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, stream.length)
+
+            headers['Content-Type'] = mimetypes.guess_type(stream.path)[0] or 'application/octet-stream'
+            headers['Content-Length'] = str(end - start + 1)
+            headers['Accept-Ranges'] = 'bytes'
+            await self.send_response(writer, status, headers)
+
+            if not send_body:
+                return
+
+            stream.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = await stream.read1(remaining)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+                remaining -= len(data)
+        except (BrokenPipeError, ConnectionResetError):
+            raise
+        except Exception as e:
+            await self.client.stdout.ERROR("Stream of \"%s\" stopped:" % stream.path, e)
+        finally:
+            stream.close()
@@ -0,0 +1,104 @@
+__author__ = 'L-ING'
+
+import os
+
+# bytes after the read position whose pieces are requested first
+STREAM_READAHEAD = 8388608
+# seconds between two checks of the client while waiting for pieces
+STREAM_WAIT_TIMEOUT = 1
+
+
+class FileStream(object):
+    """
+    Read only file-like view of a selected file, usable while the torrent downloads:
+
+    - read() waits until the pieces covering the data are verified and written
+    - the pieces from the read position to readahead bytes after it are requested before any other
+    - async iterating yields the file in order, up to the end of one piece at a time
+    """
+
+    def __init__(self, client, file_id, readahead=STREAM_READAHEAD):
+        self.client = client
+        self.pieces_manager = client.pieces_manager
+        file_table = self.pieces_manager.file_table
+        if not 0 <= file_id < file_table.number_of_files or not file_table.selected[file_id]:
+            raise Exception("File %d is not selected." % file_id)
+
+        self.file_id: int = file_id
+        self.path: str = file_table.file_names[file_id]['path']
+        self.file_start, self.file_end = file_table.get_file_range(file_id)
+        self.length: int = self.file_end - self.file_start
+        self.readahead: int = readahead
+        self.position: int = 0
+        self.closed: bool = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self.read1()
+        if not data:
+            raise StopAsyncIteration
+        return data
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self.position + offset
+        elif whence == os.SEEK_END:
+            position = self.length + offset
+        else:
+            raise ValueError("Invalid whence %d" % whence)
+
+        self.position = max(position, 0)
+        return self.position
+
+    async def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed stream.")
+
+        remaining = self.length - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            self.pieces_manager.clear_priority(self)
+            return b''
+
+        offset = self.file_start + self.position
+        first_piece, last_piece = self.pieces_manager.get_data_pieces(offset, size)
+        readahead_piece = self.pieces_manager.get_data_pieces(min(offset + self.readahead, self.file_end) - 1, 1)[0]
+        self.pieces_manager.set_priority(self, first_piece, max(last_piece, readahead_piece))
+
+        while not await self.pieces_manager.wait_for_pieces(first_piece, last_piece, STREAM_WAIT_TIMEOUT):
+            if not self.client.is_active:
+                raise Exception("Download stopped before the data of \"%s\" was available." % self.path)
+
+        data = await self.pieces_manager.read_data(offset, size)
+        if data is None or len(data) != size:
+            raise Exception("Failed to read \"%s\" from storage." % self.path)
+
+        self.position += size
+        return bytes(data)
+
+    async def read1(self, size=-1):
+        # read at most up to the end of the piece at the read position, without waiting for the next ones
+        offset = self.file_start + self.position
+        piece_length = self.pieces_manager.torrent.piece_length
+        piece_remaining = piece_length - offset % piece_length
+        if size is None or size < 0 or size > piece_remaining:
+            size = piece_remaining
+        return await self.read(size)
+
+    def close(self):
+        self.pieces_manager.clear_priority(self)
+        self.closed = True